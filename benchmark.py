@@ -0,0 +1,480 @@
+"""Нагрузочный тест бота без сети
+
+Подменяет фабрику YoutubeDL в пуле экстракторов детерминированным
+фейковым экстрактором и направляет Bot на локальную заглушку Bot API,
+после чего гоняет
+handle_search -> handle_selection -> handle_download от N одновременных
+пользователей и печатает p50/p95/p99, пропускную способность, пиковую
+RSS и пиковый объем временных файлов.
+
+Пример:
+    python benchmark.py --users 50 --rounds 3 --download-latency 0.5
+    python benchmark.py --users 20 --fail-p95 10  # для CI: код 1 при регрессии
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import shutil
+import socket
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from aiohttp import web
+
+# Настройки фейков; заполняются из аргументов командной строки
+FAKE = {
+    'search_latency': 0.3,
+    'extract_latency': 0.2,
+    'download_latency': 1.0,
+    'transcode_latency': 0.5,
+    'api_latency': 0.02,
+    'file_size_mb': 4.0,
+    'failure_rate': 0.0,
+    'flood_rate': 0.0,
+}
+
+
+# ================== ФЕЙКОВЫЙ YOUTUBE ==================
+def _video_id(seed: str) -> str:
+    return hashlib.md5(seed.encode()).hexdigest()[:11]
+
+
+def _stable_random(video_id: str) -> random.Random:
+    return random.Random(int(hashlib.md5(video_id.encode()).hexdigest(), 16))
+
+
+class FakeYoutubeDL:
+    """Детерминированная замена yt_dlp.YoutubeDL с настраиваемыми задержками"""
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _video_info(self, video_id: str) -> dict:
+        rnd = _stable_random(video_id)
+        duration = rnd.randint(120, 420)
+        return {
+            'id': video_id,
+            'title': f"Track {video_id}",
+            'uploader': f"Artist {video_id[:3]}",
+            'channel': f"Artist {video_id[:3]}",
+            'duration': duration,
+            'duration_string': f"{duration // 60}:{duration % 60:02d}",
+            'acodec': 'opus',
+            'ext': 'webm',
+            'url': f"https://fake.invalid/{video_id}",
+            'view_count': rnd.randint(1000, 10 ** 7),
+        }
+
+    def extract_info(self, url: str, download: bool = False, **kwargs):
+        if url.startswith('ytsearch'):
+            spec, query = url.split(':', 1)
+            limit = int(spec[len('ytsearch'):] or 1)
+            # playlist_items "a-b": постраничный поиск бота
+            first, _, last = self.params.get('playlist_items', f"1-{limit}").partition('-')
+            time.sleep(FAKE['search_latency'])
+            return {'entries': [
+                self._video_info(_video_id(f"{query.lower()}:{i}"))
+                for i in range(int(first) - 1, min(limit, int(last or limit)))
+            ]}
+
+        video_id = url.rsplit('=', 1)[-1].rsplit('/', 1)[-1]
+        time.sleep(FAKE['extract_latency'])
+        if _stable_random(video_id + ':fail').random() < FAKE['failure_rate']:
+            return None  # так ведет себя yt-dlp с ignoreerrors
+        info = self._video_info(video_id)
+        return self.process_ie_result(info, download=True) if download else info
+
+    def process_ie_result(self, info: dict, download: bool = True, **kwargs):
+        if not download:
+            return info
+        path = self.prepare_filename(info)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        size = int(FAKE['file_size_mb'] * 1024 * 1024 * info['duration'] / 240)
+        chunk = b'\0' * (256 * 1024)
+        chunks = max(1, math.ceil(size / len(chunk)))
+        hooks = self.params.get('progress_hooks') or []
+        started = time.monotonic()
+        with open(path, 'wb') as f:
+            for i in range(chunks):
+                f.write(chunk)
+                time.sleep(FAKE['download_latency'] / chunks)
+                downloaded = (i + 1) * len(chunk)
+                elapsed = max(time.monotonic() - started, 1e-6)
+                for hook in hooks:
+                    hook({
+                        'status': 'downloading',
+                        'downloaded_bytes': downloaded,
+                        'total_bytes': chunks * len(chunk),
+                        'speed': downloaded / elapsed,
+                        'eta': (chunks - i - 1) * FAKE['download_latency'] / chunks,
+                    })
+        for hook in hooks:
+            hook({'status': 'finished', 'filename': path})
+        return info
+
+    def prepare_filename(self, info: dict) -> str:
+        outtmpl = self.params.get('outtmpl', '%(title)s.%(ext)s')
+        if isinstance(outtmpl, dict):
+            outtmpl = outtmpl.get('default', '%(title)s.%(ext)s')
+        home = (self.params.get('paths') or {}).get('home', '')
+        return os.path.join(home, outtmpl % info)
+
+
+def fake_transcode(src: str, dest: str, quality: str, acodec: str = None) -> float:
+    """Вместо ffmpeg: копия файла и пауза"""
+    time.sleep(FAKE['transcode_latency'])
+    shutil.copyfile(src, dest)
+    return 0.0
+
+
+# ================== ФЕЙКОВЫЙ BOT API ==================
+class FakeTelegramAPI:
+    """Минимальная заглушка Bot API на aiohttp"""
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+    def __init__(self):
+        self.requests = {}
+        self.uploaded_bytes = 0
+        self.error_messages = 0
+        self.flood_errors = 0
+        self._message_id = 0
+        self._file_id = 0
+        self._rnd = random.Random(0)
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id or 0), 'type': 'private'},
+            'from': self.BOT_USER,
+            **extra,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.requests[method] = self.requests.get(method, 0) + 1
+        data = await request.post()
+        await asyncio.sleep(FAKE['api_latency'])
+
+        # Имитация flood control: 429 с retry_after
+        if 'chat_id' in data and self._rnd.random() < FAKE['flood_rate']:
+            self.flood_errors += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }, status=429)
+
+        text = data.get('text') or ''
+        if isinstance(text, str) and text.startswith('❌'):
+            self.error_messages += 1
+
+        if method == 'getMe':
+            result = self.BOT_USER
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self._message(data.get('chat_id'), text=text)
+        elif method == 'sendAudio':
+            # Файл приходит отдельной частью multipart, в audio - attach://...
+            files = [value for value in data.values() if hasattr(value, 'file')]
+            for upload in files:
+                upload.file.seek(0, os.SEEK_END)
+                self.uploaded_bytes += upload.file.tell()
+            if files:
+                self._file_id += 1
+                file_id = f"fake_file_{self._file_id}"
+            else:
+                file_id = str(data.get('audio'))
+            result = self._message(data.get('chat_id'), audio={
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'duration': int(data.get('duration') or 0),
+            })
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, port: int) -> web.AppRunner:
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+# ================== НАГРУЗКА ==================
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+def peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+class LoadRunner:
+    def __init__(self, bot_module, args):
+        self.botm = bot_module
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.latencies = {'search': [], 'select': [], 'download': []}
+        self.exceptions = 0
+        self.peak_temp = 0
+        self._update_id = 0
+        # Популярность запросов по Ципфу: несколько хитов и длинный хвост
+        self.queries = [f"song {i}" for i in range(args.queries)]
+        self.weights = [1 / (i + 1) for i in range(args.queries)]
+
+    def _next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, user_id: int):
+        types = self.botm.types
+        return types.User(id=user_id, is_bot=False, first_name=f"user{user_id}")
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False):
+        types = self.botm.types
+        return types.Message(
+            message_id=self._next_id(),
+            date=datetime.now(),
+            chat=types.Chat(id=user_id, type='private'),
+            from_user=self._user(user_id) if not from_bot else types.User(
+                id=1, is_bot=True, first_name='Bench'
+            ),
+            text=text,
+        )
+
+    async def _feed(self, kind: str, update):
+        started = time.monotonic()
+        try:
+            await self.botm.dp.feed_update(self.botm.bot, update)
+        except Exception as e:
+            self.exceptions += 1
+            print(f"⚠️ {kind}: {e}")
+        self.latencies[kind].append(time.monotonic() - started)
+
+    async def _callback(self, kind: str, user_id: int, data: str):
+        types = self.botm.types
+        update = types.Update(
+            update_id=self._next_id(),
+            callback_query=types.CallbackQuery(
+                id=str(self._next_id()),
+                from_user=self._user(user_id),
+                chat_instance=str(user_id),
+                data=data,
+                message=self._message(user_id, "results", from_bot=True),
+            )
+        )
+        await self._feed(kind, update)
+
+    async def user_session(self, user_id: int):
+        types = self.botm.types
+        for _ in range(self.args.rounds):
+            query = self.rnd.choices(self.queries, self.weights)[0]
+            await self._feed('search', types.Update(
+                update_id=self._next_id(), message=self._message(user_id, query)
+            ))
+
+            # Те же id, что вернет фейковый поиск
+            video_id = _video_id(f"{query}:{self.rnd.randint(0, 2)}")
+            await self._callback('select', user_id, f"select_{video_id}")
+            await self._callback('download', user_id, f"download_{video_id}")
+
+    async def sample_disk(self):
+        while True:
+            self.peak_temp = max(self.peak_temp, dir_size(str(self.botm.TEMP_DIR)))
+            await asyncio.sleep(0.05)
+
+    async def run(self) -> float:
+        sampler = asyncio.create_task(self.sample_disk())
+        started = time.monotonic()
+        await asyncio.gather(*[
+            self.user_session(1000 + i) for i in range(self.args.users)
+        ])
+        elapsed = time.monotonic() - started
+        sampler.cancel()
+        return elapsed
+
+
+def report(runner: LoadRunner, api: FakeTelegramAPI, elapsed: float) -> dict:
+    result = {'elapsed': elapsed, 'operations': {}}
+    print("\n" + "=" * 66)
+    print(f"{'Операция':<10}{'N':>6}{'p50, с':>10}{'p95, с':>10}{'p99, с':>10}{'max, с':>10}")
+    for kind, values in runner.latencies.items():
+        row = {
+            'count': len(values),
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+            'max': max(values) if values else 0.0,
+        }
+        result['operations'][kind] = row
+        print(f"{kind:<10}{row['count']:>6}{row['p50']:>10.3f}{row['p95']:>10.3f}"
+              f"{row['p99']:>10.3f}{row['max']:>10.3f}")
+    print("=" * 66)
+
+    downloads = len(runner.latencies['download'])
+    total_ops = sum(len(v) for v in runner.latencies.values())
+    result.update({
+        'downloads_per_sec': downloads / elapsed if elapsed else 0.0,
+        'ops_per_sec': total_ops / elapsed if elapsed else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_temp_mb': runner.peak_temp / 1024 / 1024,
+        'uploaded_mb': api.uploaded_bytes / 1024 / 1024,
+        'error_messages': api.error_messages,
+        'flood_errors': api.flood_errors,
+        'exceptions': runner.exceptions,
+        'api_requests': api.requests,
+    })
+    print(f"⏱ Время: {elapsed:.2f} с")
+    print(f"🚀 Пропускная способность: {result['downloads_per_sec']:.2f} скачиваний/с, "
+          f"{result['ops_per_sec']:.2f} операций/с")
+    print(f"🧠 Пиковая RSS: {result['peak_rss_mb']:.1f} MB")
+    print(f"💾 Пик временных файлов: {result['peak_temp_mb']:.1f} MB")
+    print(f"📤 Загружено в Telegram: {result['uploaded_mb']:.1f} MB")
+    print(f"❌ Сообщений об ошибке: {api.error_messages}, исключений: {runner.exceptions}, "
+          f"ответов 429: {api.flood_errors}")
+    print(f"📡 Запросы к Bot API: {json.dumps(api.requests, ensure_ascii=False)}")
+    return result
+
+
+async def run_benchmark(args) -> dict:
+    port = free_port()
+    api = FakeTelegramAPI()
+    api_runner = await api.start(port)
+
+    # Бот читает настройки из окружения при импорте
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:BENCHMARK-TOKEN',
+        'TELEGRAM_API_URL': f"http://127.0.0.1:{port}",
+        'DOWNLOAD_WORKERS': str(args.download_workers),
+        'TRANSCODE_WORKERS': str(args.transcode_workers),
+        'DOWNLOAD_QUEUE_LIMIT': str(args.users * args.rounds),
+        'TRANSCODE_QUEUE_LIMIT': str(args.users * args.rounds),
+        'CACHE_MAX_MB': '0' if args.no_cache else str(args.cache_mb),
+    })
+    import bot as bot_module
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    bot_module.extractor_pool.factory = FakeYoutubeDL
+    bot_module.transcoder.run = fake_transcode
+    if args.no_cache:
+        bot_module.search_cache.max_size = 0
+        async def no_file_id(*args):
+            return None
+        bot_module.audio_cache.get_file_id = no_file_id
+
+    runner = LoadRunner(bot_module, args)
+    try:
+        elapsed = await runner.run()
+        return report(runner, api, elapsed)
+    finally:
+        await bot_module.storage.close()
+        await bot_module.stats_store.close()
+        await bot_module.bot.session.close()
+        await api_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный тест музыкального бота")
+    parser.add_argument('--users', type=int, default=20, help="одновременных пользователей")
+    parser.add_argument('--rounds', type=int, default=2, help="сценариев на пользователя")
+    parser.add_argument('--queries', type=int, default=30, help="различных запросов")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--transcode-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--cache-mb', type=int, default=512)
+    parser.add_argument('--no-cache', action='store_true', help="отключить все кэши")
+    parser.add_argument('--search-latency', type=float, default=FAKE['search_latency'])
+    parser.add_argument('--extract-latency', type=float, default=FAKE['extract_latency'])
+    parser.add_argument('--download-latency', type=float, default=FAKE['download_latency'])
+    parser.add_argument('--transcode-latency', type=float, default=FAKE['transcode_latency'])
+    parser.add_argument('--api-latency', type=float, default=FAKE['api_latency'])
+    parser.add_argument('--file-size-mb', type=float, default=FAKE['file_size_mb'])
+    parser.add_argument('--failure-rate', type=float, default=FAKE['failure_rate'])
+    parser.add_argument('--flood-rate', type=float, default=FAKE['flood_rate'],
+                        help="доля запросов, на которые Bot API ответит 429")
+    parser.add_argument('--json', help="сохранить результат в JSON-файл")
+    parser.add_argument('--fail-p95', type=float, help="код возврата 1, если p95 скачивания больше")
+    parser.add_argument('--keep', action='store_true', help="не удалять рабочую папку")
+    parser.add_argument('--verbose', action='store_true', help="логи бота уровня INFO")
+    args = parser.parse_args()
+
+    for key in FAKE:
+        FAKE[key] = getattr(args, key)
+
+    # Все файлы бота (базы, кэш, temp_downloads) - во временной папке
+    workdir = tempfile.mkdtemp(prefix="music_bot_bench_")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(workdir)
+    print(f"📁 Рабочая папка: {workdir}")
+
+    try:
+        sys.path.insert(0, script_dir)
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        os.chdir(script_dir)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    download_p95 = result['operations']['download']['p95']
+    if args.fail_p95 is not None and download_p95 > args.fail_p95:
+        print(f"\n❌ p95 скачивания {download_p95:.3f} с > {args.fail_p95} с")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
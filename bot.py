@@ -1,30 +1,188 @@
+import time
+IMPORT_STARTED = time.monotonic()  # отсюда считается время старта бота
+
 import os
+import re
 import asyncio
 import aiohttp
-import yt_dlp
-import ffmpeg
+from aiohttp import web
 import logging
+import signal
 import tempfile
 import shutil
+import functools
+import sqlite3
+import threading
+import subprocess
+import json
+import copy
+import heapq
+import itertools
+from contextlib import contextmanager, asynccontextmanager
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramAPIError, TelegramRetryAfter
+from aiogram.methods import EditMessageText
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 
 # ================== НАСТРОЙКА ==================
 TOKEN = os.getenv("TELEGRAM_TOKEN") or "YOUR_BOT_TOKEN"
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
 
+# Режим получения обновлений: "polling" (по умолчанию) или "webhook".
+# HTTP-сервер (health-check, вебхук) работает в event loop бота в обоих режимах
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+
+# Свой адрес Bot API (локальный сервер или заглушка для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
 # Папка для временных файлов
 TEMP_DIR = Path("temp_downloads")
 TEMP_DIR.mkdir(exist_ok=True)
 
+# Рабочие папки задач: сироты старше TEMP_MAX_AGE секунд удаляются, а при
+# превышении TEMP_MAX_MB - самые старые, даже если они моложе
+TEMP_MAX_AGE = int(os.getenv("TEMP_MAX_AGE", "3600"))
+TEMP_MAX_MB = int(os.getenv("TEMP_MAX_MB", "2048"))
+
+# Журнал скачиваний: после перезапуска незавершенные задачи продолжаются,
+# если им не больше JOB_RESUME_MAX_AGE секунд и было меньше JOB_MAX_ATTEMPTS попыток
+JOB_RESUME_MAX_AGE = int(os.getenv("JOB_RESUME_MAX_AGE", str(6 * 3600)))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Пулы воркеров yt-dlp: быстрые поиски и медленные скачивания идут в разных
+# очередях, чтобы чужое скачивание не добавляло задержку к /search
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4"))
+SEARCH_QUEUE_LIMIT = int(os.getenv("SEARCH_QUEUE_LIMIT", "50"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "2"))
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv("DOWNLOAD_QUEUE_LIMIT", "20"))
+# Разбор страниц по ссылкам и предзагрузка - в своем небольшом пуле,
+# чтобы фоновая работа не занимала воркеры и очередь поиска
+RESOLVE_WORKERS = int(os.getenv("RESOLVE_WORKERS", "2"))
+RESOLVE_QUEUE_LIMIT = int(os.getenv("RESOLVE_QUEUE_LIMIT", "10"))
+
+# Планировщик скачиваний: одновременно выполняется не больше DOWNLOAD_SLOTS
+# задач (скачивание + перекодирование), у одного пользователя - не больше
+# USER_MAX_ACTIVE, еще USER_MAX_QUEUED могут ждать. Короткие треки идут первыми,
+# очереди разных пользователей чередуются. ADMIN_ID обслуживается вне очереди
+DOWNLOAD_SLOTS = int(os.getenv("DOWNLOAD_SLOTS", "0")) or DOWNLOAD_WORKERS * 2
+USER_MAX_ACTIVE = int(os.getenv("USER_MAX_ACTIVE", "1"))
+USER_MAX_QUEUED = int(os.getenv("USER_MAX_QUEUED", "5"))
+
+# Перекодирование - отдельный этап конвейера: по одному ffmpeg на ядро
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "0")) or os.cpu_count() or 1
+TRANSCODE_QUEUE_LIMIT = int(os.getenv("TRANSCODE_QUEUE_LIMIT", "20"))
+
+# Как часто (не чаще, секунды) обновлять сообщение с прогрессом скачивания
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", "3"))
+
+# Предзагрузка при выборе трека: "off", "resolve" (только разобрать страницу
+# и подписи потоков) или "download" (сразу скачать в дисковый кэш).
+# PREFETCH_MAX_ACTIVE - общий бюджет одновременных фоновых задач.
+# Разобранная страница живет, пока не истекли подписи потоков, но не дольше PREFETCH_TTL
+PREFETCH_MODE = os.getenv("PREFETCH_MODE", "resolve")
+PREFETCH_MAX_ACTIVE = int(os.getenv("PREFETCH_MAX_ACTIVE", "3"))
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", "3600"))
+
+# Лимит Bot API на отправку файла (50 MB; у локального сервера Bot API - 2000).
+# Длинные треки заранее понижаются до битрейта из FALLBACK_BITRATES, который
+# влезает в лимит, а безнадежные отклоняются до скачивания
+UPLOAD_LIMIT_MB = int(os.getenv("UPLOAD_LIMIT_MB", "50"))
+FALLBACK_BITRATES = ("320", "192", "128", "96", "64")
+
+# Inline-режим (@bot название): ответ не позже INLINE_DEADLINE секунд из кэшей
+# и индекса; нескачанные треки приходят заглушкой и заменяются аудио после
+# загрузки (нужен /setinlinefeedback у BotFather). Файл для замены сначала
+# загружается в INLINE_CACHE_CHAT_ID (служебный канал) или в личку пользователя
+INLINE_DEADLINE = float(os.getenv("INLINE_DEADLINE", "1.5"))
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", "10"))
+INLINE_CACHE_CHAT_ID = int(os.getenv("INLINE_CACHE_CHAT_ID", "0"))
+
+# Экстракторы yt-dlp создаются один раз и переиспользуются: до EXTRACTOR_POOL_SIZE
+# свободных экземпляров на профиль настроек, каждый пересоздается после
+# EXTRACTOR_MAX_USES задач (куки и внутренние кэши не копятся бесконечно)
+EXTRACTOR_POOL_SIZE = int(os.getenv("EXTRACTOR_POOL_SIZE", "0")) or max(SEARCH_WORKERS, DOWNLOAD_WORKERS)
+EXTRACTOR_MAX_USES = int(os.getenv("EXTRACTOR_MAX_USES", "100"))
+
+# Плейлисты и альбомы: список разворачивается порциями по PLAYLIST_PAGE_SIZE,
+# одновременно качается до PLAYLIST_PARALLEL треков, готовые отправляются
+# по порядку. Больше PLAYLIST_MAX_TRACKS треков из одного плейлиста не берем
+PLAYLIST_PAGE_SIZE = int(os.getenv("PLAYLIST_PAGE_SIZE", "10"))
+PLAYLIST_PARALLEL = int(os.getenv("PLAYLIST_PARALLEL", "3"))
+PLAYLIST_MAX_TRACKS = int(os.getenv("PLAYLIST_MAX_TRACKS", "50"))
+
+# Качество "original": лучший родной поток m4a/AAC без перекодирования в MP3
+ORIGINAL_QUALITY = "original"
+QUALITY_NAMES = {
+    "320": "Высокое (320kbps)",
+    "192": "Среднее (192kbps)",
+    "128": "Низкое (128kbps)",
+    ORIGINAL_QUALITY: "Оригинал (без перекодирования)",
+}
+
+# Кэш готовых треков: file_id Telegram и MP3 на диске в пределах бюджета
+DB_PATH = os.getenv("DB_PATH", "music_bot.db")
+CACHE_DIR = Path(os.getenv("CACHE_DIR", "audio_cache"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "2048")) * 1024 * 1024
+
+# Кэш результатов поиска: TTL в секундах, размер в записях и необязательный
+# файл, в который кэш сохраняется при остановке и читается при запуске
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1000"))
+SEARCH_CACHE_FILE = os.getenv("SEARCH_CACHE_FILE", "")
+
+# Постраничный поиск: первая страница маленькая и быстрая, следующие
+# догружаются по кнопке «Еще результаты» (не больше SEARCH_MAX_RESULTS)
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "5"))
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "50"))
+
+# Прямые ссылки на аудиопоток подписаны и живут до метки expire в самой
+# ссылке; без метки - STREAM_URL_TTL секунд
+STREAM_URL_TTL = int(os.getenv("STREAM_URL_TTL", "300"))
+
+# Локальный индекс уже отправленных треков: если совпадение с запросом не
+# ниже TRACK_INDEX_MIN_SCORE (коэффициент Дайса по триграммам, 0..1), поиск отвечает
+# из индекса без YouTube. Значение больше 1 отключает индекс
+TRACK_INDEX_MIN_SCORE = float(os.getenv("TRACK_INDEX_MIN_SCORE", "0.75"))
+
+# FSM-хранилище на SQLite: результаты поиска живут FSM_TTL секунд,
+# настройки пользователя (PERSISTENT_FSM_KEYS) - бессрочно
+FSM_DB_PATH = os.getenv("FSM_DB_PATH", DB_PATH)
+FSM_TTL = int(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_HOT_SIZE = int(os.getenv("FSM_HOT_SIZE", "1000"))
+PERSISTENT_FSM_KEYS = {"quality"}
+
+# Статистика пишется в базу пачками: каждые N событий или T секунд
+STATS_FLUSH_EVENTS = int(os.getenv("STATS_FLUSH_EVENTS", "50"))
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "30"))
+
+# Лимиты исходящих запросов к Bot API (сообщений в секунду)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -32,144 +190,2233 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================== ХРАНИЛИЩЕ FSM ==================
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище на SQLite (WAL) с горячим LRU в памяти
+
+    Память ограничена размером LRU, остальное лежит на диске и переживает
+    перезапуск. Все обращения к базе идут через один поток, чтобы не
+    блокировать event loop.
+    """
+
+    def __init__(self, db_path: str, ttl: int, hot_size: int):
+        self.ttl = ttl
+        self.hot_size = hot_size
+        self._hot = OrderedDict()  # key -> {'state', 'prefs', 'data', 'expires'}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm_db")
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS fsm (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                prefs TEXT,
+                data TEXT,
+                expires REAL
+            )
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id or 0,
+                 getattr(key, 'business_connection_id', None) or '', key.destiny]
+        return ":".join(str(part) for part in parts)
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    # ---------- работа с базой (поток fsm_db) ----------
+    def _read_row(self, key: str) -> dict:
+        row = self._db.execute(
+            "SELECT state, prefs, data, expires FROM fsm WHERE key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return {'state': None, 'prefs': {}, 'data': {}, 'expires': 0}
+        return {
+            'state': row[0],
+            'prefs': json.loads(row[1]) if row[1] else {},
+            'data': json.loads(row[2]) if row[2] else {},
+            'expires': row[3] or 0,
+        }
+
+    def _write_row(self, key: str, record: dict):
+        if not record['state'] and not record['prefs'] and not record['data']:
+            self._db.execute("DELETE FROM fsm WHERE key = ?", (key,))
+        else:
+            self._db.execute(
+                "INSERT OR REPLACE INTO fsm VALUES (?, ?, ?, ?, ?)",
+                (key, record['state'], _compact_json(record['prefs']),
+                 _compact_json(record['data']), record['expires'])
+            )
+        self._db.commit()
+
+    def _purge_sync(self, now: float) -> int:
+        cursor = self._db.execute(
+            "UPDATE fsm SET state = NULL, data = NULL WHERE expires < ? "
+            "AND (state IS NOT NULL OR data IS NOT NULL)",
+            (now,)
+        )
+        self._db.execute("DELETE FROM fsm WHERE state IS NULL AND data IS NULL AND prefs IS NULL")
+        self._db.commit()
+        return cursor.rowcount
+
+    # ---------- горячий кэш ----------
+    def _remember(self, key: str, record: dict):
+        self._hot[key] = record
+        self._hot.move_to_end(key)
+        while len(self._hot) > self.hot_size:
+            self._hot.popitem(last=False)
+
+    async def _load(self, key: str) -> dict:
+        record = self._hot.get(key)
+        if record is None:
+            record = await self._call(self._read_row, key)
+            self._remember(key, record)
+        else:
+            self._hot.move_to_end(key)
+
+        # Истекли результаты поиска и состояние - настройки остаются
+        if record['expires'] < time.time():
+            record['state'] = None
+            record['data'] = {}
+        return record
+
+    async def _save(self, key: str, record: dict):
+        self._remember(key, record)
+        snapshot = dict(record, prefs=dict(record['prefs']), data=dict(record['data']))
+        await self._call(self._write_row, key, snapshot)
+
+    # ---------- интерфейс BaseStorage ----------
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        k = self._key(key)
+        record = await self._load(k)
+        record['state'] = state.state if isinstance(state, State) else state
+        record['expires'] = time.time() + self.ttl
+        await self._save(k, record)
+
+    async def get_state(self, key: StorageKey):
+        record = await self._load(self._key(key))
+        return record['state']
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        k = self._key(key)
+        record = await self._load(k)
+        record['prefs'] = {name: value for name, value in data.items() if name in PERSISTENT_FSM_KEYS}
+        record['data'] = {name: value for name, value in data.items() if name not in PERSISTENT_FSM_KEYS}
+        record['expires'] = time.time() + self.ttl
+        await self._save(k, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = await self._load(self._key(key))
+        return {**record['data'], **record['prefs']}
+
+    async def purge_expired(self) -> int:
+        """Удаляет истекшие результаты поиска из базы и горячего кэша"""
+        now = time.time()
+        for key in [k for k, r in self._hot.items() if r['expires'] < now]:
+            del self._hot[key]
+        return await self._call(self._purge_sync, now)
+
+    async def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+
+def _compact_json(value):
+    """Компактный JSON без пробелов; пустые значения храним как NULL"""
+    if not value:
+        return None
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
 # ================== ИНИЦИАЛИЗАЦИЯ ==================
-storage = MemoryStorage()
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+storage = SQLiteStorage(FSM_DB_PATH, FSM_TTL, FSM_HOT_SIZE)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher(storage=storage)
 
-# Статистика
-stats = {
-    "total_downloads": 0,
-    "failed_downloads": 0,
-    "users": {},
-    "start_time": datetime.now().isoformat()
+BOT_STARTED = datetime.now()
+STARTUP_SECONDS = None  # от начала импорта до готовности принимать обновления
+
+
+def mark_ready():
+    global STARTUP_SECONDS
+    STARTUP_SECONDS = time.monotonic() - IMPORT_STARTED
+    logger.info(f"Ready to serve updates in {STARTUP_SECONDS:.2f}s")
+
+# ================== СТАТИСТИКА ==================
+class StatsStore:
+    """Почасовые счетчики в SQLite
+
+    События копятся в памяти (по одному счетчику на метрику за час) и
+    записываются пачкой, поэтому горячий путь не трогает диск. /stats
+    читает уже агрегированные строки.
+    """
+
+    def __init__(self, db_path: str, flush_events: int):
+        self.flush_events = flush_events
+        self._counters = Counter()  # (hour, metric) -> value
+        self._users = set()  # (day, user_id)
+        self._buffered = 0
+        self._flush_task = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stats_db")
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS stats_hourly (
+                hour TEXT NOT NULL,
+                metric TEXT NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (hour, metric)
+            );
+            CREATE TABLE IF NOT EXISTS stats_users (
+                day TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                PRIMARY KEY (day, user_id)
+            );
+        """)
+        self._db.commit()
+
+    def record(self, *metrics: str, user_id: int = None):
+        """Учитывает событие; вызывать только из event loop"""
+        hour = datetime.now().strftime("%Y-%m-%d %H")
+        for metric in metrics:
+            self._counters[(hour, metric)] += 1
+        if user_id is not None:
+            self._users.add((hour[:10], user_id))
+
+        self._buffered += 1
+        if self._buffered >= self.flush_events and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if not self._counters and not self._users:
+            return
+        counters, users = self._counters, self._users
+        self._counters, self._users, self._buffered = Counter(), set(), 0
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write, counters, users)
+
+    def _write(self, counters: Counter, users: set):
+        self._db.executemany(
+            "INSERT INTO stats_hourly VALUES (?, ?, ?) "
+            "ON CONFLICT(hour, metric) DO UPDATE SET value = value + excluded.value",
+            [(hour, metric, value) for (hour, metric), value in counters.items()]
+        )
+        self._db.executemany("INSERT OR IGNORE INTO stats_users VALUES (?, ?)", list(users))
+        self._db.commit()
+
+    async def run_flusher(self, interval: int):
+        """Фоновый сброс по таймеру"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Stats flush error: {e}")
+
+    async def summary(self) -> dict:
+        await self.flush()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._summary_sync)
+
+    def _summary_sync(self) -> dict:
+        now = datetime.now()
+        since_24h = (now - timedelta(hours=24)).strftime("%Y-%m-%d %H")
+        today = now.strftime("%Y-%m-%d")
+
+        def totals(where: str = "", params: tuple = ()) -> dict:
+            rows = self._db.execute(
+                f"SELECT metric, SUM(value) FROM stats_hourly {where} GROUP BY metric", params
+            ).fetchall()
+            return dict(rows)
+
+        return {
+            'all': totals(),
+            'last_24h': totals("WHERE hour > ?", (since_24h,)),
+            'users_total': self._db.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM stats_users"
+            ).fetchone()[0],
+            'users_today': self._db.execute(
+                "SELECT COUNT(*) FROM stats_users WHERE day = ?", (today,)
+            ).fetchone()[0],
+        }
+
+    async def close(self):
+        await self.flush()
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+
+stats_store = StatsStore(DB_PATH, STATS_FLUSH_EVENTS)
+
+# ================== МЕТРИКИ ==================
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и gauge в текстовом формате Prometheus
+
+    Без внешних зависимостей; обновлять можно из любых потоков.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._help = {}
+        self._types = {}
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket_counts, sum, count]
+        self._gauges = {}      # (name, labels) -> функция без аргументов
+
+    def _declare(self, name: str, kind: str, help_text: str = ""):
+        self._types.setdefault(name, kind)
+        if help_text:
+            self._help.setdefault(name, help_text)
+
+    def describe(self, name: str, kind: str, help_text: str):
+        """Заранее задает тип и описание метрики"""
+        with self._lock:
+            self._declare(name, kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, 'counter')
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, 'histogram')
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def gauge(self, name: str, func, help_text: str = "", **labels):
+        """Регистрирует gauge, значение которого читается при каждом выводе"""
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        items = labels + extra
+        if not items:
+            return ""
+        body = ",".join(
+            f'{k}="{str(v)}"'.replace("\n", " ") for k, v in items
+        )
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self._histograms.items()}
+            gauges = dict(self._gauges)
+            types_ = dict(self._types)
+            help_ = dict(self._help)
+
+        for name in sorted(types_):
+            if name in help_:
+                lines.append(f"# HELP {name} {help_[name]}")
+            lines.append(f"# TYPE {name} {types_[name]}")
+
+            for (n, labels), value in counters.items():
+                if n == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+
+            for (n, labels), func in gauges.items():
+                if n == name:
+                    try:
+                        lines.append(f"{name}{self._labels(labels)} {float(func())}")
+                    except Exception as e:
+                        logger.error(f"Gauge {name} error: {e}")
+
+            for (n, labels), (bucket_counts, total, count) in histograms.items():
+                if n != name:
+                    continue
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(
+                        f"{name}_bucket{self._labels(labels, (('le', bound),))} {bucket_count}"
+                    )
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Считает задержки и ошибки всех запросов к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        method_name = type(method).__name__
+        started = time.monotonic()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            metrics.inc(
+                "music_bot_telegram_errors_total", method=method_name, error=type(e).__name__
+            )
+            raise
+        finally:
+            metrics.observe(
+                "music_bot_telegram_request_seconds", time.monotonic() - started, method=method_name
+            )
+
+
+metrics = MetricsRegistry()
+metrics.describe("music_bot_stage_seconds", "histogram",
+                 "Задержка этапов: search, extract, download, transcode, upload")
+metrics.describe("music_bot_bytes_total", "counter", "Переданные байты по направлениям")
+metrics.describe("music_bot_cache_requests_total", "counter", "Обращения к кэшам")
+metrics.describe("music_bot_telegram_request_seconds", "histogram", "Задержка запросов к Bot API")
+metrics.describe("music_bot_telegram_errors_total", "counter", "Ошибки Bot API по методам")
+metrics.describe("music_bot_telegram_retries_total", "counter", "Повторы после flood control (429)")
+metrics.describe("music_bot_telegram_coalesced_total", "counter", "Пропущенные устаревшие правки сообщений")
+metrics.describe("music_bot_prefetch_total", "counter", "Фоновые предзагрузки по результату")
+metrics.describe("music_bot_extractors_total", "counter", "Выдачи экземпляров YoutubeDL: reused/created")
+metrics.describe("music_bot_inline_total", "counter", "Inline-запросы по результату")
+metrics.describe("music_bot_size_plan_total", "counter", "Решения о битрейте по лимиту размера")
+metrics.describe("music_bot_queue_wait_seconds", "histogram", "Ожидание слота в планировщике скачиваний")
+
+# Значения, которые читаются прямо из состояния пулов и кэшей
+for _lane_name in ("search", "resolve", "download", "transcode"):
+    metrics.gauge(
+        "music_bot_lane_pending",
+        lambda name=_lane_name: globals()[f"{name}_lane"].pending,
+        help_text="Задачи в пуле: выполняются + ждут",
+        lane=_lane_name
+    )
+    metrics.gauge(
+        "music_bot_lane_workers",
+        lambda name=_lane_name: globals()[f"{name}_lane"].workers,
+        help_text="Размер пула воркеров",
+        lane=_lane_name
+    )
+metrics.gauge(
+    "music_bot_inflight_jobs", lambda: len(download_flights),
+    help_text="Уникальные задачи в работе", kind="download"
+)
+metrics.gauge(
+    "music_bot_inflight_jobs", lambda: len(search_flights), kind="search"
+)
+metrics.gauge(
+    "music_bot_scheduler_waiting", lambda: download_scheduler.waiting,
+    help_text="Задачи, ждущие слота в планировщике"
+)
+metrics.gauge(
+    "music_bot_search_cache_hit_ratio", lambda: search_cache.hit_ratio,
+    help_text="Доля попаданий в кэш поиска"
+)
+metrics.gauge(
+    "music_bot_search_cache_entries", lambda: len(search_cache),
+    help_text="Записей в кэше поиска"
+)
+metrics.gauge(
+    "music_bot_startup_seconds", lambda: STARTUP_SECONDS or 0.0,
+    help_text="Время от импорта до готовности принимать обновления"
+)
+metrics.gauge(
+    "music_bot_extractors_idle", lambda: extractor_pool.idle_count(),
+    help_text="Свободные экземпляры YoutubeDL в пуле"
+)
+metrics.gauge(
+    "music_bot_transcode_cpu_seconds", lambda: transcoder.cpu_seconds,
+    help_text="Суммарное CPU-время ffmpeg"
+)
+
+# ================== ЛИМИТЫ BOT API ==================
+class TokenBucket:
+    """Классическое ведро токенов: rate токенов в секунду, запас capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        # Во время паузы updated указывает на ее конец - токены не копятся
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд (retry_after от Telegram)
+
+        После паузы ведро наполняется с нуля, а не сразу на весь запас.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = max(self.updated, self.paused_until)
+
+    @property
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity and self.paused_until <= time.monotonic()
+
+    async def acquire(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Центральный планировщик исходящих запросов к Bot API
+
+    Все запросы с chat_id проходят через ведро чата и общее ведро бота.
+    На 429 чат ставится на паузу retry_after секунд и запрос повторяется,
+    так что уже скачанный трек не теряется из-за flood control. Общее ведро
+    встает на паузу, только если 429 почти одновременно получили несколько
+    чатов - тогда лимит явно общий, а не одного чата. Правки
+    одного сообщения склеиваются: если пока правка ждала очереди пришла
+    более новая, старая не отправляется.
+    """
+
+    MAX_TRACKED_CHATS = 10000
+    GLOBAL_FLOOD_CHATS = 3      # столько разных чатов с 429...
+    GLOBAL_FLOOD_WINDOW = 10.0  # ...за столько секунд - пауза для всех
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int,
+                 group_rate: float, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket
+        self._edit_seq = {}                 # (chat_id, message_id) -> номер последней правки
+        self._last_edit = OrderedDict()     # (chat_id, message_id) -> отправленное содержимое
+        self._flood_chats = OrderedDict()   # chat_id -> время последнего 429
+        self._seq = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id - группы и каналы, у них лимит заметно строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(self.group_rate, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            # Забываем простаивающие чаты, чтобы словарь не рос бесконечно
+            while len(self._chat_buckets) > self.MAX_TRACKED_CHATS:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if not oldest.idle:
+                    break
+                del self._chat_buckets[oldest_id]
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _flood_is_global(self, chat_id) -> bool:
+        """Учитывает 429 чата; True, если недавно их получили несколько чатов"""
+        now = time.monotonic()
+        self._flood_chats.pop(chat_id, None)
+        self._flood_chats[chat_id] = now
+        while self._flood_chats and next(iter(self._flood_chats.values())) < now - self.GLOBAL_FLOOD_WINDOW:
+            self._flood_chats.popitem(last=False)
+        return len(self._flood_chats) >= self.GLOBAL_FLOOD_CHATS
+
+    def _remember_edit(self, edit_key, fingerprint):
+        self._last_edit[edit_key] = fingerprint
+        self._last_edit.move_to_end(edit_key)
+        while len(self._last_edit) > self.MAX_TRACKED_CHATS:
+            self._last_edit.popitem(last=False)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # answerCallbackQuery, getMe и т.п. в лимиты сообщений не входят
+            return await make_request(bot, method)
+
+        edit_key = fingerprint = seq = None
+        if isinstance(method, EditMessageText) and method.message_id:
+            edit_key = (chat_id, method.message_id)
+            fingerprint = (method.text, repr(method.reply_markup))
+            if self._last_edit.get(edit_key) == fingerprint:
+                metrics.inc("music_bot_telegram_coalesced_total")
+                return True
+            self._seq += 1
+            seq = self._edit_seq[edit_key] = self._seq
+
+        bucket = self._chat_bucket(chat_id)
+        try:
+            for attempt in range(self.max_retries + 1):
+                await bucket.acquire()
+                if edit_key and self._edit_seq.get(edit_key) != seq:
+                    # Пока ждали, пришла более свежая правка этого сообщения
+                    metrics.inc("music_bot_telegram_coalesced_total")
+                    return True
+                await self.global_bucket.acquire()
+
+                try:
+                    result = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt >= self.max_retries:
+                        raise
+                    metrics.inc("music_bot_telegram_retries_total", method=type(method).__name__)
+                    logger.warning(f"Flood control in chat {chat_id}: retry in {e.retry_after}s")
+                    bucket.pause(e.retry_after)
+                    if self._flood_is_global(chat_id):
+                        logger.warning(f"Flood control in {len(self._flood_chats)} chats: pausing all")
+                        self.global_bucket.pause(e.retry_after)
+                    continue
+                except TelegramBadRequest as e:
+                    if edit_key and "message is not modified" in str(e):
+                        return True
+                    raise
+
+                if edit_key:
+                    self._remember_edit(edit_key, fingerprint)
+                return result
+        finally:
+            if edit_key and self._edit_seq.get(edit_key) == seq:
+                del self._edit_seq[edit_key]
+
+
+rate_limiter = TelegramRateLimiter(
+    TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_GROUP_RATE, TG_MAX_RETRIES
+)
+
+# Лимитер снаружи: метрики видят каждую реальную попытку, включая 429
+bot.session.middleware(rate_limiter)
+bot.session.middleware(TelegramMetricsMiddleware())
+
+# ================== ПУЛЫ ВОРКЕРОВ ==================
+class QueueFullError(Exception):
+    """Очередь воркеров переполнена"""
+
+
+class WorkerLane:
+    """Отдельная ограниченная очередь задач со своим пулом потоков"""
+
+    def __init__(self, name: str, workers: int, queue_limit: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_limit = max(0, queue_limit)
+        self.pending = 0  # выполняются + ждут своей очереди
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix=f"{name}_worker"
+        )
+
+    @property
+    def busy(self) -> bool:
+        """Все воркеры заняты, новая задача встанет в очередь"""
+        return self.pending >= self.workers
+
+    def check_capacity(self):
+        """Бросает QueueFullError, если очередь уже заполнена"""
+        if self.pending >= self.workers + self.queue_limit:
+            raise QueueFullError(f"{self.name} queue is full ({self.pending} jobs)")
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет блокирующую функцию в пуле, не блокируя event loop"""
+        self.check_capacity()
+        return await self.submit(func, *args, **kwargs)
+
+    async def submit(self, func, *args, **kwargs):
+        """Как run(), но без проверки лимита - для уже принятых задач"""
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(func, *args, **kwargs)
+            )
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    """Склеивает одинаковые одновременные задачи в одну
+
+    Первый запрос по ключу запускает задачу, остальные подключаются к ней
+    и получают тот же результат (или то же исключение).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self._inflight
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def run(self, key, coro_factory):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        # shield: отмена одного ожидающего не отменяет общую задачу
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+
+class UserQuotaError(QueueFullError):
+    """У пользователя уже слишком много задач в очереди"""
+
+
+class FairScheduler:
+    """Справедливая очередь задач с приоритетом коротких
+
+    У каждого пользователя своя очередь, упорядоченная по длительности трека
+    (shortest-job-first). Между пользователями слот получает тот, у кого
+    наименьшее обслуженное время с учетом следующей задачи (start-time fair
+    queuing), поэтому десяток часовых миксов одного не задерживает песню
+    другого. Пользователи из priority_users выбираются раньше всех и не
+    ограничены user_limit.
+    """
+
+    def __init__(self, slots: int, user_limit: int, user_queue_limit: int,
+                 queue_limit: int, priority_users=()):
+        self.slots = max(1, slots)
+        self.user_limit = max(1, user_limit)
+        self.user_queue_limit = max(0, user_queue_limit)
+        self.queue_limit = max(0, queue_limit)
+        self.priority_users = {u for u in priority_users if u}
+        self.active = 0
+        self._active_by_user = Counter()  # (user_id, limit) -> выполняются сейчас
+        self._queues = {}  # user_id -> куча (duration, seq, future, limit)
+        self._served = {}  # user_id -> виртуальное время окончания последней задачи
+        self._vclock = 0.0
+        self._seq = itertools.count()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def _eligible(self, user_id, limit=None) -> bool:
+        """Задачи со своим limit (пакет) считаются отдельно от обычных"""
+        return (user_id in self.priority_users
+                or self._active_by_user[(user_id, limit)] < (limit or self.user_limit))
+
+    def _next_entry(self, user_id):
+        """Самая короткая задача пользователя, которую можно начать сейчас"""
+        return min(
+            (entry for entry in self._queues[user_id] if self._eligible(user_id, entry[3])),
+            default=None
+        )
+
+    def would_wait(self, user_id, limit: int = None) -> bool:
+        """Новая задача пользователя встанет в очередь, а не начнется сразу"""
+        return (self.active >= self.slots or not self._eligible(user_id, limit)
+                or any(self._next_entry(u) for u in self._queues))
+
+    def check_capacity(self, user_id):
+        if user_id in self.priority_users:
+            return
+        if self.waiting >= self.queue_limit:
+            raise QueueFullError(f"scheduler queue is full ({self.waiting} jobs)")
+        queued = sum(1 for entry in self._queues.get(user_id, ()) if entry[3] is None)
+        if queued >= self.user_queue_limit:
+            raise UserQuotaError(f"user {user_id} has {queued} queued jobs")
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, duration: float, limit: int = None):
+        """Ждет своей очереди и держит слот на время выполнения задачи
+
+        limit - свой предел одновременных задач вместо user_limit (пакет
+        треков); такие задачи не занимают квоту обычных скачиваний и не
+        отклоняются при полной очереди - их число ограничивает сам пакет.
+        """
+        await self.acquire(user_id, duration, limit)
+        try:
+            yield
+        finally:
+            self.release(user_id, limit)
+
+    async def acquire(self, user_id: int, duration: float, limit: int = None):
+        if limit is None:
+            self.check_capacity(user_id)
+        if not self.would_wait(user_id, limit):
+            self._start(user_id, duration, limit)
+            return
+
+        started = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        entry = (duration, next(self._seq), future, limit)
+        heapq.heappush(self._queues.setdefault(user_id, []), entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Слот успели выдать, но ждать уже некому - возвращаем его
+                self.release(user_id, limit)
+            else:
+                self._discard(user_id, entry)
+            raise
+        metrics.observe(
+            "music_bot_queue_wait_seconds", time.monotonic() - started,
+            lane="priority" if user_id in self.priority_users else "normal"
+        )
+
+    def release(self, user_id: int, limit: int = None):
+        self.active -= 1
+        key = (user_id, limit)
+        self._active_by_user[key] -= 1
+        if self._active_by_user[key] <= 0:
+            del self._active_by_user[key]
+        self._dispatch()
+
+    def _start(self, user_id, duration: float, limit: int = None):
+        self.active += 1
+        self._active_by_user[(user_id, limit)] += 1
+        start = max(self._served.get(user_id, 0.0), self._vclock)
+        self._vclock = start
+        self._served[user_id] = start + duration
+        # Забываем тех, кто давно отстал от часов - у них и так минимальный тег
+        if len(self._served) > 10000:
+            self._served = {u: t for u, t in self._served.items() if t > self._vclock}
+
+    def _finish_tag(self, user_id, entry) -> tuple:
+        start = max(self._served.get(user_id, 0.0), self._vclock)
+        return (user_id not in self.priority_users, start + entry[0])
+
+    def _dispatch(self):
+        while self.active < self.slots:
+            candidates = [(u, e) for u, e in ((u, self._next_entry(u)) for u in self._queues) if e]
+            if not candidates:
+                return
+            user_id, entry = min(candidates, key=lambda c: self._finish_tag(*c))
+            self._discard(user_id, entry)
+            duration, _, future, limit = entry
+            if future.done():
+                continue
+            self._start(user_id, duration, limit)
+            future.set_result(None)
+
+    def _discard(self, user_id, entry):
+        queue = self._queues.get(user_id)
+        if queue and entry in queue:
+            queue.remove(entry)
+            heapq.heapify(queue)
+            if not queue:
+                del self._queues[user_id]
+
+
+def normalize_query(query: str) -> str:
+    """Приводит запрос к каноническому виду: регистр и лишние пробелы"""
+    return " ".join(query.lower().split())
+
+
+search_lane = WorkerLane("search", SEARCH_WORKERS, SEARCH_QUEUE_LIMIT)
+resolve_lane = WorkerLane("resolve", RESOLVE_WORKERS, RESOLVE_QUEUE_LIMIT)
+download_lane = WorkerLane("download", DOWNLOAD_WORKERS, DOWNLOAD_QUEUE_LIMIT)
+transcode_lane = WorkerLane("transcode", TRANSCODE_WORKERS, TRANSCODE_QUEUE_LIMIT)
+search_flights = SingleFlight()
+download_flights = SingleFlight()
+download_scheduler = FairScheduler(
+    DOWNLOAD_SLOTS, USER_MAX_ACTIVE, USER_MAX_QUEUED, DOWNLOAD_QUEUE_LIMIT, priority_users=(ADMIN_ID,)
+)
+
+# Временные папки, файлы из которых еще отправляются: temp_dir -> число
+# пользователей. Все подключившиеся к одной задаче получают результат в одной
+# итерации event loop, поэтому счетчик успевает вырасти до первой отправки.
+# Значение 0 - папку занимает идущая задача, результата еще нет.
+temp_dir_refs = {}
+
+
+def claim_work_dir(video_id: str, quality: str) -> str:
+    """Рабочая папка задачи (video_id, качество)
+
+    Имя постоянное, поэтому после перезапуска задача найдет свои .part-файлы
+    и yt-dlp продолжит скачивание с места обрыва. Если прошлый результат
+    с тем же ключом еще отправляется, берется отдельная папка.
+    """
+    path = str(TEMP_DIR / f"{video_id}_{quality}")
+    if path in temp_dir_refs:
+        path = tempfile.mkdtemp(prefix=f"{video_id}_{quality}_", dir=TEMP_DIR)
+    os.makedirs(path, exist_ok=True)
+    temp_dir_refs[path] = 0
+    return path
+
+
+def unclaim_work_dir(path: str):
+    """Задача закончилась, а результата в этой папке никто не держит"""
+    if temp_dir_refs.get(path) == 0:
+        del temp_dir_refs[path]
+
+
+def discard_work_dir(path: str):
+    """Удаляет папку после ошибки, но оставляет недокачанное для повтора"""
+    if any(Path(path).glob("*.part")):
+        return
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _dir_age_and_size(path: Path):
+    """Секунды с последней записи в папку (по самому свежему файлу) и ее размер"""
+    newest = path.stat().st_mtime
+    size = 0
+    for item in path.rglob("*"):
+        if item.is_file():
+            st = item.stat()
+            newest = max(newest, st.st_mtime)
+            size += st.st_size
+    return time.time() - newest, size
+
+
+def _remove_path(item: Path):
+    if item.is_dir():
+        shutil.rmtree(item, ignore_errors=True)
+    else:
+        item.unlink(missing_ok=True)
+
+
+def sweep_work_dirs(busy: set, max_age: float, max_bytes: int) -> int:
+    """Удаляет рабочие папки без владельца: старые, а при нехватке места - самые старые
+
+    busy - имена папок задач, которые еще идут или ждут продолжения.
+    Возвращает число удаленных папок и файлов.
+    """
+    orphans = []
+    total = 0
+    removed = 0
+    for item in TEMP_DIR.iterdir():
+        try:
+            if item.is_file():
+                age, size = time.time() - item.stat().st_mtime, item.stat().st_size
+            else:
+                age, size = _dir_age_and_size(item)
+        except OSError:
+            continue
+        total += size
+        if str(item) in temp_dir_refs or item.name in busy:
+            continue
+        if age > max_age:
+            _remove_path(item)
+            total -= size
+            removed += 1
+        else:
+            orphans.append((age, size, item))
+    
+    # Бюджет диска: сначала самые давно не тронутые
+    for age, size, item in sorted(orphans, key=lambda o: o[0], reverse=True):
+        if total <= max_bytes:
+            break
+        _remove_path(item)
+        total -= size
+        removed += 1
+    return removed
+
+# ================== КЭШ ТРЕКОВ ==================
+class AudioCache:
+    """Кэш готовых треков по (video_id, качество)
+
+    Сначала запоминаем file_id, который Telegram вернул после send_audio -
+    повторная отправка по нему ничего не скачивает и не загружает.
+    Дополнительно храним сами MP3 на диске с LRU-вытеснением по размеру.
+    Обращения из event loop идут через свой поток, как у StatsStore.
+    """
+
+    def __init__(self, db_path: str, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio_db")
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS audio_file_ids (
+                key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                title TEXT,
+                artist TEXT,
+                duration INTEGER,
+                created REAL
+            );
+            CREATE TABLE IF NOT EXISTS audio_files (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                filename TEXT,
+                size INTEGER NOT NULL,
+                title TEXT,
+                artist TEXT,
+                duration INTEGER,
+                last_used REAL
+            );
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def _key(video_id: str, quality: str) -> str:
+        return f"{video_id}:{quality}"
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    # ---------- file_id Telegram ----------
+    async def get_file_id(self, video_id: str, quality: str):
+        return await self._call(self._get_file_id_sync, video_id, quality)
+
+    async def put_file_id(self, video_id: str, quality: str, file_id: str, meta: dict):
+        await self._call(self._put_file_id_sync, video_id, quality, file_id, meta)
+
+    async def drop_file_id(self, video_id: str, quality: str):
+        await self._call(self._drop_file_id_sync, video_id, quality)
+
+    def _get_file_id_sync(self, video_id: str, quality: str):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_id, title, artist, duration FROM audio_file_ids WHERE key = ?",
+                (self._key(video_id, quality),)
+            ).fetchone()
+        if not row:
+            return None
+        return {'file_id': row[0], 'title': row[1], 'artist': row[2], 'duration': row[3]}
+
+    def _put_file_id_sync(self, video_id: str, quality: str, file_id: str, meta: dict):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO audio_file_ids VALUES (?, ?, ?, ?, ?, ?)",
+                (self._key(video_id, quality), file_id, meta.get('title'),
+                 meta.get('artist'), int(meta.get('duration') or 0), time.time())
+            )
+            self._db.commit()
+
+    def iter_file_ids(self):
+        """Все сохраненные file_id: (video_id, quality, file_id, title, artist, duration)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT key, file_id, title, artist, duration FROM audio_file_ids"
+            ).fetchall()
+        for key, file_id, title, artist, duration in rows:
+            video_id, _, quality = key.rpartition(':')
+            yield video_id, quality, file_id, title, artist, duration
+
+    def _drop_file_id_sync(self, video_id: str, quality: str):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM audio_file_ids WHERE key = ?", (self._key(video_id, quality),)
+            )
+            self._db.commit()
+
+    # ---------- файлы на диске ----------
+    async def get_file(self, video_id: str, quality: str):
+        """Путь и метаданные закэшированного файла (или None)"""
+        return await self._call(self._get_file_sync, video_id, quality)
+
+    def _get_file_sync(self, video_id: str, quality: str):
+        key = self._key(video_id, quality)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT path, filename, title, artist, duration FROM audio_files WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if not row:
+                return None
+            if not os.path.exists(row[0]):
+                self._db.execute("DELETE FROM audio_files WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute(
+                "UPDATE audio_files SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+        return {'path': row[0], 'filename': row[1], 'title': row[2],
+                'artist': row[3], 'duration': row[4]}
+
+    def put_file(self, video_id: str, quality: str, src_path: str, meta: dict):
+        """Переносит готовый файл в кэш и вытесняет самые старые"""
+        size = os.path.getsize(src_path)
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return None
+
+        key = self._key(video_id, quality)
+        ext = os.path.splitext(src_path)[1]
+        dest = self.cache_dir / f"{video_id}_{quality}{ext}"
+        shutil.move(src_path, dest)
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO audio_files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, str(dest), meta.get('filename'), size, meta.get('title'),
+                 meta.get('artist'), int(meta.get('duration') or 0), time.time())
+            )
+            self._evict()
+            self._db.commit()
+        return str(dest)
+
+    def _evict(self):
+        """Удаляет давно не использованные файлы, пока не влезем в бюджет"""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM audio_files").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Только что выданные файлы могут еще загружаться в Telegram
+        in_use_since = time.time() - 120
+        rows = self._db.execute(
+            "SELECT key, path, size FROM audio_files WHERE last_used < ? ORDER BY last_used ASC",
+            (in_use_since,)
+        ).fetchall()
+        for key, path, size in rows:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._db.execute("DELETE FROM audio_files WHERE key = ?", (key,))
+            total -= size
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+
+class TTLCache:
+    """LRU-кэш в памяти с временем жизни записей и счетчиками попаданий"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (value, expires_at)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = item
+        if expires_at < time.time():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        item = self._data.pop(key, None)
+        return item[0] if item else None
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def save(self, path: str):
+        """Сохраняет живые записи в JSON (ключи-кортежи пишутся списками)"""
+        now = time.time()
+        items = [
+            [list(key) if isinstance(key, tuple) else key, value, expires_at]
+            for key, (value, expires_at) in self._data.items()
+            if expires_at > now
+        ]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            items = json.load(f)
+        now = time.time()
+        for key, value, expires_at in items:
+            if expires_at > now:
+                self._data[tuple(key) if isinstance(key, list) else key] = (value, expires_at)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class TrackIndex:
+    """Нечеткий поиск по уже отправленным трекам (триграммы названия и канала)
+
+    Строится при запуске из таблицы file_id и пополняется после каждой
+    отправки, так что популярные запросы обходятся без ytsearch.
+    """
+
+    def __init__(self):
+        self._tracks = {}  # video_id -> {'id', 'title', 'channel', 'duration', 'file_ids'}
+        self._grams = {}  # video_id -> (триграммы названия, триграммы названия с каналом)
+        self._postings = {}  # триграмма -> set(video_id)
+
+    def __len__(self) -> int:
+        return len(self._tracks)
+
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        words = " ".join(re.findall(r"\w+", (text or "").lower()))
+        if not words:
+            return set()
+        padded = f"  {words} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def load(self, cache: AudioCache) -> int:
+        for video_id, quality, file_id, title, artist, duration in cache.iter_file_ids():
+            self.add(video_id, quality, file_id, {'title': title, 'artist': artist, 'duration': duration})
+        return len(self._tracks)
+
+    def add(self, video_id: str, quality: str, file_id: str, meta: dict):
+        track = self._tracks.get(video_id)
+        if track is None:
+            seconds = int(meta.get('duration') or 0)
+            track = self._tracks[video_id] = {
+                'id': video_id,
+                'title': meta.get('title') or 'Без названия',
+                'channel': meta.get('artist') or 'Неизвестно',
+                'duration': f"{seconds // 60}:{seconds % 60:02d}" if seconds else '0:00',
+                'file_ids': {},
+            }
+            # "(Official Video)" и подобное в скобках только размывает сходство
+            core = re.sub(r"[(\[].*?[)\]]", " ", track['title'])
+            title_grams = self._trigrams(core)
+            full_grams = self._trigrams(f"{core} {track['channel']}")
+            self._grams[video_id] = (title_grams, full_grams)
+            for gram in full_grams:
+                self._postings.setdefault(gram, set()).add(video_id)
+        track['file_ids'][quality] = file_id
+
+    def get(self, video_id: str):
+        return self._tracks.get(video_id)
+
+    def drop_file_id(self, video_id: str, quality: str):
+        """Трек остается в индексе - его все еще можно найти и скачать заново"""
+        track = self._tracks.get(video_id)
+        if track:
+            track['file_ids'].pop(quality, None)
+
+    @staticmethod
+    def _dice(query: set, grams: set) -> float:
+        return 2 * len(query & grams) / (len(query) + len(grams)) if grams else 0.0
+
+    def search(self, query: str, limit: int, min_score: float) -> list:
+        """Треки, похожие на запрос не меньше чем на min_score, лучшие первыми
+
+        Сходство симметричное: запрос из одного слова не совпадает с
+        длинным названием, где это слово просто встречается.
+        """
+        grams = self._trigrams(query)
+        if not grams or min_score > 1:
+            return []
+        counts = Counter()
+        for gram in grams:
+            counts.update(self._postings.get(gram, ()))
+        # Дайс >= s требует хотя бы s/2 общих триграмм от запроса - остальное не считаем
+        threshold = min_score * len(grams) / 2
+        matches = []
+        for video_id, n in counts.items():
+            if n < threshold:
+                continue
+            score = max(self._dice(grams, g) for g in self._grams[video_id])
+            if score >= min_score:
+                matches.append((score, video_id))
+        # При равном сходстве короче название - точнее совпадение
+        matches.sort(key=lambda m: (-m[0], len(self._tracks[m[1]]['title'])))
+        return [self._tracks[video_id] for _, video_id in matches[:limit]]
+
+
+def stream_url_ttl(url: str) -> float:
+    """Сколько секунд подписанная ссылка googlevideo еще действительна (с запасом)"""
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get('expire', [None])[0]
+    if expire is None:
+        # Ссылки для HLS/DASH несут параметры в пути: .../expire/1700000000/...
+        match = re.search(r"/expire/(\d+)", parsed.path)
+        expire = match.group(1) if match else None
+    if expire is None or not expire.isdigit():
+        return STREAM_URL_TTL
+    return int(expire) - time.time() - 60
+
+
+def info_ttl(info: dict) -> float:
+    """Срок годности разобранной страницы - по самой ранней подписи ее потоков"""
+    urls = [f['url'] for f in info.get('formats') or () if f.get('url')]
+    if info.get('url'):
+        urls.append(info['url'])
+    return min((stream_url_ttl(url) for url in urls), default=STREAM_URL_TTL)
+
+
+audio_cache = AudioCache(DB_PATH, CACHE_DIR, CACHE_MAX_BYTES)
+search_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+track_index = TrackIndex()
+
+# ================== ЖУРНАЛ ЗАДАЧ ==================
+class JobStore:
+    """Незавершенные скачивания в SQLite
+
+    Запись появляется до начала работы и удаляется, когда пользователь
+    получил трек или ошибку. Все, что осталось после падения или выкатки,
+    при запуске продолжается с тем же статусным сообщением. Запросы к базе
+    идут через свой поток, как у StatsStore.
+    """
+
+    def __init__(self, db_path: str):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs_db")
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS download_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                video_id TEXT NOT NULL,
+                quality TEXT NOT NULL,
+                duration INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created REAL
+            );
+        """)
+        self._db.commit()
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    # ---------- работа с базой (поток jobs_db) ----------
+    def _add_sync(self, row: tuple) -> int:
+        cursor = self._db.execute(
+            "INSERT INTO download_jobs (user_id, chat_id, message_id, video_id, quality, duration, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            row
+        )
+        self._db.commit()
+        return cursor.lastrowid
+
+    def _execute_sync(self, sql: str, params: tuple):
+        self._db.execute(sql, params)
+        self._db.commit()
+
+    def _unfinished_sync(self) -> list:
+        rows = self._db.execute(
+            "SELECT id, user_id, chat_id, message_id, video_id, quality, duration, attempts, created "
+            "FROM download_jobs ORDER BY id"
+        ).fetchall()
+        keys = ('id', 'user_id', 'chat_id', 'message_id', 'video_id', 'quality',
+                'duration', 'attempts', 'created')
+        return [dict(zip(keys, row)) for row in rows]
+
+    def _active_keys_sync(self) -> set:
+        return set(self._db.execute("SELECT DISTINCT video_id, quality FROM download_jobs").fetchall())
+
+    # ---------- интерфейс ----------
+    async def add(self, user_id: int, chat_id: int, message_id: int,
+                  video_id: str, quality: str, duration: int) -> int:
+        row = (user_id, chat_id, message_id, video_id, quality, int(duration or 0), time.time())
+        return await self._call(self._add_sync, row)
+
+    async def start(self, job_id: int):
+        """Считает попытки, чтобы задача, роняющая процесс, не повторялась вечно"""
+        await self._call(
+            self._execute_sync, "UPDATE download_jobs SET attempts = attempts + 1 WHERE id = ?", (job_id,)
+        )
+
+    async def finish(self, job_id: int):
+        await self._call(self._execute_sync, "DELETE FROM download_jobs WHERE id = ?", (job_id,))
+
+    async def unfinished(self) -> list:
+        return await self._call(self._unfinished_sync)
+
+    async def active_keys(self) -> set:
+        return await self._call(self._active_keys_sync)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._db.close()
+
+
+job_store = JobStore(DB_PATH)
+
+# ================== ПЕРЕКОДИРОВАНИЕ ==================
+class TranscodeError(Exception):
+    """ffmpeg завершился с ошибкой"""
+
+
+class Transcoder:
+    """Запуск ffmpeg с учетом CPU-времени каждого задания
+
+    Каждый воркер transcode_lane ведет ровно один процесс ffmpeg с -threads 1,
+    так что число одновременно занятых ядер равно размеру пула.
+    """
+
+    def __init__(self, ffmpeg_bin: str):
+        self.ffmpeg_bin = ffmpeg_bin
+        self.jobs = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def build_args(self, src: str, dest: str, quality: str, acodec: str = None) -> list:
+        args = [
+            self.ffmpeg_bin, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+            '-i', src, '-vn', '-threads', '1',
+        ]
+        if quality == ORIGINAL_QUALITY:
+            if (acodec or '').startswith('mp4a'):
+                # AAC уже в нужном виде - только перепаковываем
+                args += ['-c:a', 'copy']
+            else:
+                args += ['-c:a', 'aac', '-b:a', '192k']
+        else:
+            args += ['-c:a', 'libmp3lame', '-b:a', f'{quality}k']
+        return args + [dest]
+
+    def run(self, src: str, dest: str, quality: str, acodec: str = None) -> float:
+        """Блокирующее перекодирование, возвращает CPU-время ffmpeg в секундах"""
+        proc = subprocess.Popen(
+            self.build_args(src, dest, quality, acodec),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        stderr = proc.stderr.read()
+        proc.stderr.close()
+
+        if hasattr(os, 'wait4'):
+            # wait4 отдает rusage именно этого процесса
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            cpu_time = usage.ru_utime + usage.ru_stime
+        else:
+            proc.wait()
+            cpu_time = 0.0
+
+        if proc.returncode != 0:
+            raise TranscodeError(stderr.decode(errors='replace').strip()[-300:])
+
+        with self._lock:
+            self.jobs += 1
+            self.cpu_seconds += cpu_time
+        return cpu_time
+
+
+transcoder = Transcoder(FFMPEG_BIN)
+
+# ================== РАЗМЕР ФАЙЛА ==================
+class TrackTooLargeError(Exception):
+    """Трек не влезет в лимит Bot API даже на минимальном битрейте"""
+
+
+class QualityTooHighError(TrackTooLargeError):
+    """Настоящая длительность известна только после разбора страницы:
+    на выбранном битрейте трек не влезет, а на quality - влезет"""
+
+    def __init__(self, message: str, quality: str, info: dict = None):
+        super().__init__(message)
+        self.quality = quality
+        self.info = info
+
+
+def estimate_size(duration: float, quality: str) -> int:
+    """Оценка размера результата в байтах по длительности и битрейту"""
+    # "original" - AAC ~128-160k, но при перекодировании выходит 192k: берем с запасом
+    kbps = 192 if quality == ORIGINAL_QUALITY else int(quality)
+    # +2% на контейнер и кадры, +64 KB на теги
+    return int(duration * kbps * 1000 / 8 * 1.02) + 64 * 1024
+
+
+def fit_quality(quality: str, duration: float) -> str:
+    """Лучшее качество не выше выбранного, с которым файл пройдет в лимит
+
+    При неизвестной длительности возвращает выбранное качество без изменений.
+    """
+    limit = UPLOAD_LIMIT_MB * 1024 * 1024
+    if not duration or estimate_size(duration, quality) <= limit:
+        return quality
+    for bitrate in FALLBACK_BITRATES:
+        if quality != ORIGINAL_QUALITY and int(bitrate) > int(quality):
+            continue
+        if estimate_size(duration, bitrate) <= limit:
+            return bitrate
+    raise TrackTooLargeError(
+        f"{int(duration) // 60} min does not fit {UPLOAD_LIMIT_MB} MB even at {FALLBACK_BITRATES[-1]}kbps"
+    )
+
+# ================== ПРОГРЕСС СКАЧИВАНИЯ ==================
+def _format_bytes(size) -> str:
+    return f"{(size or 0) / 1024 / 1024:.1f} MB"
+
+
+class DownloadProgress:
+    """Прогресс одной задачи скачивания
+
+    Хуки yt-dlp и этап перекодирования вызываются из рабочих потоков и
+    передают данные в event loop через call_soon_threadsafe; сообщения
+    пользователей обновляет report_progress() не чаще PROGRESS_INTERVAL.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.stage = 'queued'
+        self.downloaded = 0
+        self.total = None
+        self.speed = None
+        self.eta = None
+
+    def hook(self, d: dict):
+        """progress_hooks для yt-dlp (вызывается из потока скачивания)"""
+        if d.get('status') != 'downloading':
+            return
+        self.loop.call_soon_threadsafe(self._apply, {
+            'stage': 'download',
+            'downloaded': d.get('downloaded_bytes') or 0,
+            'total': d.get('total_bytes') or d.get('total_bytes_estimate'),
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+        })
+
+    def set_stage(self, stage: str):
+        """Смена этапа: extract, download, transcode (из любого потока)"""
+        self.loop.call_soon_threadsafe(self._apply, {'stage': stage})
+
+    def _apply(self, data: dict):
+        for name, value in data.items():
+            setattr(self, name, value)
+
+    def render(self, quality: str):
+        """Текст статуса; None - пока в очереди (там свое сообщение)"""
+        if self.stage == 'extract':
+            return "🔎 <b>Получаю информацию о треке...</b>"
+        if self.stage == 'transcode':
+            target = "m4a" if quality == ORIGINAL_QUALITY else "MP3"
+            return f"🎛 <b>Конвертирую в {target}...</b>"
+        if self.stage != 'download':
+            return None
+
+        lines = ["⬇️ <b>Скачиваю трек...</b>"]
+        if self.total:
+            percent = min(100, int(self.downloaded * 100 / self.total))
+            bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+            lines.append(f"{bar} {percent}% ({_format_bytes(self.downloaded)} / {_format_bytes(self.total)})")
+        else:
+            lines.append(f"📦 {_format_bytes(self.downloaded)}")
+        details = []
+        if self.speed:
+            details.append(f"🚀 {_format_bytes(self.speed)}/s")
+        if self.eta is not None:
+            details.append(f"⏱ осталось {int(self.eta) // 60}:{int(self.eta) % 60:02d}")
+        if details:
+            lines.append(", ".join(details))
+        return "\n".join(lines)
+
+
+# Прогресс общих задач: (video_id, quality) -> DownloadProgress
+download_progress = {}
+
+
+async def report_progress(msg: types.Message, progress: DownloadProgress, quality: str):
+    """Обновляет статус, пока задача не завершится (задачу отменяют снаружи)"""
+    last_text = None
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+        text = progress.render(quality)
+        if text and text != last_text:
+            try:
+                await msg.edit_text(text)
+                last_text = text
+            except TelegramAPIError as e:
+                logger.warning(f"Progress update failed: {e}")
+
+async def set_status(msg, text: str):
+    """Меняет статусное сообщение; пользователь мог его удалить - это не ошибка задачи"""
+    try:
+        await msg.edit_text(text)
+    except TelegramAPIError as e:
+        logger.warning(f"Status update failed: {e}")
+
+# ================== ЭКСТРАКТОРЫ YT-DLP ==================
+yt_dlp = None  # импортируется при первом обращении, см. load_yt_dlp()
+
+
+def load_yt_dlp():
+    """Отложенный импорт yt_dlp: бот начинает отвечать, не дожидаясь его"""
+    global yt_dlp
+    if yt_dlp is None:
+        started = time.monotonic()
+        import yt_dlp as module
+        yt_dlp = module
+        metrics.observe("music_bot_stage_seconds", time.monotonic() - started, stage="import")
+        logger.info(f"yt_dlp imported in {time.monotonic() - started:.2f}s")
+    return yt_dlp
+
+
+# Неизменные настройки по профилям. Между задачами меняются только параметры,
+# которые yt-dlp читает в момент вызова: paths, playlist_items
+EXTRACTOR_PROFILES = {
+    'search': {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': True,
+        'skip_download': True,
+        'default_search': 'ytsearch',
+        'format': 'bestaudio/best',
+    },
+    'resolve': {
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'geo_bypass': True,
+        'ignoreerrors': True,
+    },
+    'download': {
+        'format': 'bestaudio/best',
+        'outtmpl': '%(title)s.%(ext)s',
+        'quiet': False,
+        'no_warnings': True,
+        'noplaylist': True,
+        'geo_bypass': True,
+        'ignoreerrors': True,
+        'logtostderr': False,
+        'verbose': False,
+        'no_color': True,
+    },
+    'direct': {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+    },
+    'playlist': {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'skip_download': True,
+        'ignoreerrors': True,
+    },
 }
+# Для "original" берем родной m4a, чтобы потом только перепаковать
+EXTRACTOR_PROFILES['download_original'] = dict(
+    EXTRACTOR_PROFILES['download'], format='bestaudio[ext=m4a]/bestaudio/best'
+)
+
+
+class _Extractor:
+    """Экземпляр YoutubeDL и его текущий хук прогресса"""
+
+    def __init__(self, factory, params: dict):
+        self.hook = None
+        self.uses = 0
+        # Хуки yt-dlp фиксируются при создании - ставим один, который
+        # передает события хуку текущей задачи
+        params['progress_hooks'] = [self._on_progress]
+        self.ydl = factory(params)
+
+    def _on_progress(self, d: dict):
+        if self.hook:
+            self.hook(d)
+
+    def close(self):
+        close = getattr(self.ydl, 'close', None)
+        if close:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+class ExtractorPool:
+    """Пул готовых экземпляров YoutubeDL по профилям настроек
+
+    Создание YoutubeDL - это разбор настроек, загрузка куки и классов
+    экстракторов; переиспользуя экземпляры, платим за это один раз.
+    Экземпляр не потокобезопасен, поэтому выдается одной задаче за раз.
+    """
+
+    def __init__(self, profiles: dict, max_idle: int, max_uses: int):
+        self.profiles = profiles
+        self.max_idle = max(1, max_idle)
+        self.max_uses = max(1, max_uses)
+        self.factory = None  # по умолчанию yt_dlp.YoutubeDL
+        self._idle = {name: [] for name in profiles}
+        self._lock = threading.Lock()
+
+    def _create(self, profile: str) -> _Extractor:
+        params = dict(self.profiles[profile])
+        if profile != 'search':
+            params['cookiefile'] = 'cookies.txt' if os.path.exists('cookies.txt') else None
+        started = time.monotonic()
+        extractor = _Extractor(self.factory or load_yt_dlp().YoutubeDL, params)
+        metrics.observe("music_bot_stage_seconds", time.monotonic() - started, stage="extractor_init")
+        return extractor
+
+    @contextmanager
+    def lease(self, profile: str, progress_hook=None, **overrides):
+        """Выдает экземпляр профиля; overrides действуют только на эту задачу"""
+        with self._lock:
+            idle = self._idle[profile]
+            extractor = idle.pop() if idle else None
+        metrics.inc("music_bot_extractors_total", profile=profile,
+                    result="reused" if extractor else "created")
+        if extractor is None:
+            extractor = self._create(profile)
+
+        params = extractor.ydl.params
+        saved = {key: params[key] for key in overrides if key in params}
+        params.update(overrides)
+        extractor.hook = progress_hook
+        healthy = False
+        try:
+            yield extractor.ydl
+            healthy = True
+        finally:
+            extractor.hook = None
+            for key in overrides:
+                if key in saved:
+                    params[key] = saved[key]
+                else:
+                    params.pop(key, None)
+            extractor.uses += 1
+            self._give_back(profile, extractor, healthy)
+
+    def _give_back(self, profile: str, extractor: _Extractor, healthy: bool):
+        # После исключения состояние экземпляра неизвестно - не рискуем
+        if healthy and extractor.uses < self.max_uses:
+            with self._lock:
+                idle = self._idle[profile]
+                if len(idle) < self.max_idle:
+                    idle.append(extractor)
+                    return
+        extractor.close()
+
+    def warm(self, profiles):
+        """Заранее создает по экземпляру профилей (блокирующий, для пула потоков)"""
+        for profile in profiles:
+            with self.lease(profile):
+                pass
+
+    def idle_count(self) -> int:
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+
+extractor_pool = ExtractorPool(EXTRACTOR_PROFILES, EXTRACTOR_POOL_SIZE, EXTRACTOR_MAX_USES)
+
+
+async def warm_extractors():
+    """Импорт yt_dlp и первые экземпляры - в фоне, когда бот уже отвечает"""
+    try:
+        started = time.monotonic()
+        await search_lane.submit(extractor_pool.warm, ('search',))
+        await resolve_lane.submit(extractor_pool.warm, ('resolve',))
+        await download_lane.submit(extractor_pool.warm, ('download',))
+        logger.info(f"Extractors warmed in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        logger.warning(f"Extractor warm-up failed: {e}")
 
 # ================== РЕАЛЬНОЕ СКАЧИВАНИЕ ==================
 class YouTubeDownloader:
     """Класс для реального скачивания музыки с YouTube"""
     
     @staticmethod
-    async def search_youtube(query: str, limit: int = 10):
-        """Поиск видео на YouTube"""
-        try:
-            ydl_opts = {
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
-                'skip_download': True,
-                'default_search': 'ytsearch',
-                'format': 'bestaudio/best',
-            }
+    async def search_youtube(query: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+        """Поиск видео на YouTube: результаты с offset+1 по offset+limit
+
+        Кэш хранит страницы по SEARCH_PAGE_SIZE, поэтому личный чат и
+        inline-режим пользуются одними и теми же записями.
+        """
+        q = normalize_query(query)
+        first = offset - offset % SEARCH_PAGE_SIZE
+        starts = range(first, offset + limit, SEARCH_PAGE_SIZE)
+        pages = {start: search_cache.get((q, SEARCH_PAGE_SIZE, start)) for start in starts}
+        missing = [start for start, page in pages.items() if page is None]
+        if not missing:
+            stats_store.record("search_cache_hit")
+            metrics.inc("music_bot_cache_requests_total", cache="search", result="hit")
+        else:
+            stats_store.record("search_cache_miss")
+            metrics.inc("music_bot_cache_requests_total", cache="search", result="miss")
+        
+        # Ошибки не превращаем в пустой результат: он означал бы конец выдачи
+        if missing:
+            # Недостающие страницы - одним запросом к YouTube
+            span = (missing[0], missing[-1] + SEARCH_PAGE_SIZE)
+            fetched = await search_flights.run(
+                ('search', q) + span,
+                lambda: YouTubeDownloader._fetch_pages(query, q, *span)
+            )
+            pages.update(fetched)
+        
+        videos = [video for start in starts for video in pages[start] or []]
+        return videos[offset - first:offset - first + limit]
+    
+    @staticmethod
+    async def _fetch_pages(query: str, q: str, start: int, end: int) -> dict:
+        """Ищет результаты start..end и кладет их в кэш постранично
+
+        Работает внутри общей задачи SingleFlight: кэш заполняется, даже если
+        все ожидающие уже ушли (inline-запрос, не успевший к сроку).
+        """
+        videos = await search_lane.run(YouTubeDownloader._search_sync, query, end - start, start)
+        pages = {}
+        for page_start in range(start, end, SEARCH_PAGE_SIZE):
+            page = videos[page_start - start:page_start - start + SEARCH_PAGE_SIZE]
+            pages[page_start] = page
+            if page:
+                search_cache.set((q, SEARCH_PAGE_SIZE, page_start), page)
+        return pages
+    
+    @staticmethod
+    def _search_sync(query: str, limit: int, offset: int = 0):
+        """Блокирующий поиск, выполняется в пуле search_lane"""
+        # Уже показанные результаты не разбираем повторно
+        lease = extractor_pool.lease('search', playlist_items=f"{offset + 1}-{offset + limit}")
+        
+        with lease as ydl, metrics.timer("music_bot_stage_seconds", stage="search"):
+            result = ydl.extract_info(f"ytsearch{offset + limit}:{query}", download=False)
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                result = ydl.extract_info(f"ytsearch{limit}:{query}", download=False)
-                
-                if not result or 'entries' not in result:
-                    return []
-                
-                videos = []
-                for entry in result['entries'][:limit]:
-                    if entry:
-                        videos.append({
-                            'id': entry.get('id'),
-                            'title': entry.get('title', 'Без названия'),
-                            'duration': entry.get('duration_string', '0:00'),
-                            'thumbnail': entry.get('thumbnail'),
-                            'url': entry.get('url'),
-                            'channel': entry.get('channel', 'Неизвестно'),
-                            'views': entry.get('view_count', 0)
-                        })
-                return videos
-                
-        except Exception as e:
-            logger.error(f"Search error: {e}")
-            return []
+            if not result or 'entries' not in result:
+                return []
+            
+            videos = []
+            for entry in list(result['entries'])[:limit]:
+                if entry:
+                    videos.append({
+                        'id': entry.get('id'),
+                        'title': entry.get('title', 'Без названия'),
+                        'duration': entry.get('duration_string', '0:00'),
+                        'thumbnail': entry.get('thumbnail'),
+                        'url': entry.get('url'),
+                        'channel': entry.get('channel', 'Неизвестно'),
+                        'views': entry.get('view_count', 0)
+                    })
+            return videos
     
     @staticmethod
     async def download_audio(video_id: str, quality: str = "192"):
         """Скачивание аудио в MP3"""
-        temp_file = None
         try:
-            # Создаем временную папку
-            temp_dir = tempfile.mkdtemp(prefix="music_bot_", dir=TEMP_DIR)
-            
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
-                'postprocessors': [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': quality,
-                }],
-                'quiet': False,
-                'no_warnings': True,
-                'extractaudio': True,
-                'audioformat': 'mp3',
-                'noplaylist': True,
-                'geo_bypass': True,
-                'ignoreerrors': True,
-                'logtostderr': False,
-                'verbose': False,
-                'no_color': True,
-                'cookiefile': 'cookies.txt' if os.path.exists('cookies.txt') else None,
+            audio_file = await download_flights.run(
+                (video_id, quality), lambda: YouTubeDownloader._fetch(video_id, quality)
+            )
+            if audio_file and 'temp_dir' in audio_file:
+                temp_dir = audio_file['temp_dir']
+                temp_dir_refs[temp_dir] = temp_dir_refs.get(temp_dir, 0) + 1
+            return audio_file
+        except (QueueFullError, TrackTooLargeError):
+            raise
+        except Exception as e:
+            logger.error(f"Download error: {e}")
+            return None
+    
+    @staticmethod
+    def progress_for(video_id: str, quality: str) -> DownloadProgress:
+        """Прогресс задачи; вызывать прямо перед download_audio, без await между ними"""
+        key = (video_id, quality)
+        progress = download_progress.get(key)
+        if progress is None:
+            progress = download_progress[key] = DownloadProgress(asyncio.get_running_loop())
+        return progress
+    
+    @staticmethod
+    async def _fetch(video_id: str, quality: str):
+        """Конвейер: кэш -> скачивание (сеть) -> перекодирование (CPU)"""
+        key = (video_id, quality)
+        progress = YouTubeDownloader.progress_for(video_id, quality)
+        try:
+            return await YouTubeDownloader._run_pipeline(video_id, quality, progress)
+        finally:
+            if download_progress.get(key) is progress:
+                del download_progress[key]
+    
+    @staticmethod
+    async def _run_pipeline(video_id: str, quality: str, progress: DownloadProgress):
+        # Трек уже лежит в дисковом кэше - YouTube не трогаем
+        cached = await audio_cache.get_file(video_id, quality)
+        if cached:
+            stats_store.record("disk_cache_hit")
+            metrics.inc("music_bot_cache_requests_total", cache="disk", result="hit")
+            return {
+                'path': cached['path'],
+                'filename': cached['filename'] or os.path.basename(cached['path']),
+                'title': cached['title'] or 'audio',
+                'artist': cached['artist'] or 'Unknown',
+                'duration': cached['duration'] or 0,
             }
+        
+        stats_store.record("disk_cache_miss")
+        metrics.inc("music_bot_cache_requests_total", cache="disk", result="miss")
+        
+        # Не тратим трафик, если перекодировать результат все равно некому
+        transcode_lane.check_capacity()
+        
+        # Страница могла быть разобрана заранее, пока пользователь смотрел карточку
+        info = await prefetcher.warm_info(video_id)
+        work_dir = claim_work_dir(video_id, quality)
+        audio_file = None
+        try:
+            try:
+                source = await download_lane.run(
+                    YouTubeDownloader._download_sync, video_id, quality, progress, info, work_dir
+                )
+            except QualityTooHighError as e:
+                # Тот же трек битрейтом ниже; разобранная страница не пропадает
+                metrics.inc("music_bot_size_plan_total", result="downgraded")
+                prefetcher.remember(video_id, e.info)
+                audio_file = await YouTubeDownloader._run_pipeline(video_id, e.quality, progress)
+                return dict(audio_file, quality=e.quality) if audio_file else None
+            if not source:
+                return None
+            
+            # Скачанное уже принято в работу - в очередь перекодирования без отказа
+            audio_file = await transcode_lane.submit(
+                YouTubeDownloader._transcode_sync, video_id, quality, source, progress
+            )
+            return audio_file
+        finally:
+            if not audio_file or audio_file.get('temp_dir') != work_dir:
+                unclaim_work_dir(work_dir)
+            else:
+                # Ждущие забирают файл сразу после завершения задачи. Своя ссылка
+                # задачи отпускается чуть позже: если все ждущие отменились
+                # (например, предзагрузка), папка не повиснет навсегда
+                temp_dir_refs[work_dir] = temp_dir_refs.get(work_dir, 0) + 1
+                asyncio.get_running_loop().call_later(1.0, YouTubeDownloader.release, audio_file)
+    
+    @staticmethod
+    def release(audio_file: dict):
+        """Освобождает временный файл после отправки (кэшированные не трогаем)"""
+        temp_dir = audio_file.get('temp_dir')
+        if not temp_dir:
+            return
+        refs = temp_dir_refs.get(temp_dir, 1) - 1
+        if refs > 0:
+            temp_dir_refs[temp_dir] = refs
+            return
+        temp_dir_refs.pop(temp_dir, None)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _download_sync(video_id: str, quality: str, progress: DownloadProgress = None,
+                       info: dict = None, work_dir: str = None):
+        """Блокирующее скачивание исходного потока, выполняется в пуле download_lane
+
+        info - заранее полученный сырой результат extract_info(process=False);
+        с ним этап разбора страницы пропускается. work_dir - папка задачи
+        (см. claim_work_dir); недокачанный .part в ней yt-dlp продолжит.
+        """
+        if progress:
+            progress.set_stage('extract')
+        
+        temp_dir = work_dir or tempfile.mkdtemp(prefix=f"{video_id}_{quality}_", dir=TEMP_DIR)
+        
+        try:
+            profile = 'download_original' if quality == ORIGINAL_QUALITY else 'download'
+            lease = extractor_pool.lease(
+                profile, progress_hook=progress.hook if progress else None, paths={'home': temp_dir}
+            )
             
             url = f"https://www.youtube.com/watch?v={video_id}"
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                downloaded_file = ydl.prepare_filename(info)
+            with lease as ydl:
+                # Разбираем страницу и качаем поток отдельно, чтобы видеть,
+                # какая из фаз медленная
+                if info is None:
+                    with metrics.timer("music_bot_stage_seconds", stage="extract"):
+                        info = ydl.extract_info(url, download=False, process=False)
+                # Длительность из поиска могла быть неизвестна - сверяемся с
+                # настоящей, пока не скачан ни один байт
+                if info and info.get('duration'):
+                    planned = fit_quality(quality, info['duration'])
+                    if planned != quality:
+                        raise QualityTooHighError(f"{video_id} does not fit at {quality}", planned, info)
+                if info:
+                    with metrics.timer("music_bot_stage_seconds", stage="download"):
+                        info = ydl.process_ie_result(info, download=True)
+                source_file = ydl.prepare_filename(info) if info else None
                 
-                # Меняем расширение на .mp3
-                base, _ = os.path.splitext(downloaded_file)
-                mp3_file = base + '.mp3'
-                
-                if os.path.exists(mp3_file):
-                    # Читаем файл
-                    with open(mp3_file, 'rb') as f:
-                        audio_data = f.read()
-                    
-                    temp_file = {
-                        'data': audio_data,
-                        'filename': os.path.basename(mp3_file),
+                if source_file and os.path.exists(source_file):
+                    metrics.inc("music_bot_bytes_total", os.path.getsize(source_file), direction="download")
+                    return {
+                        'source': source_file,
+                        'acodec': info.get('acodec'),
                         'title': info.get('title', 'audio'),
                         'artist': info.get('uploader', 'Unknown'),
                         'duration': info.get('duration', 0),
-                        'temp_dir': temp_dir
+                        'temp_dir': temp_dir,
                     }
-                    return temp_file
-                    
-            return None
             
-        except Exception as e:
-            logger.error(f"Download error: {e}")
-            if temp_file and 'temp_dir' in temp_file:
-                shutil.rmtree(temp_file['temp_dir'], ignore_errors=True)
+            discard_work_dir(temp_dir)
             return None
+            
+        except Exception:
+            discard_work_dir(temp_dir)
+            raise
     
     @staticmethod
-    async def get_direct_link(video_id: str):
-        """Получение прямой ссылки на аудио (альтернативный метод)"""
+    def _transcode_sync(video_id: str, quality: str, source: dict, progress: DownloadProgress = None):
+        """Блокирующее перекодирование, выполняется в пуле transcode_lane"""
+        temp_dir = source['temp_dir']
+        if progress:
+            progress.set_stage('transcode')
+        
         try:
-            ydl_opts = {
-                'format': 'bestaudio/best',
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True,
+            # Итоговое расширение: .mp3 или .m4a для "original"
+            codec = 'm4a' if quality == ORIGINAL_QUALITY else 'mp3'
+            base, ext = os.path.splitext(source['source'])
+            out_file = f"{base}.{codec}"
+            if ext == f".{codec}":
+                out_file = f"{base}.out.{codec}"
+            
+            started = time.monotonic()
+            cpu_time = transcoder.run(source['source'], out_file, quality, source.get('acodec'))
+            wall_time = time.monotonic() - started
+            os.remove(source['source'])
+            metrics.observe("music_bot_stage_seconds", wall_time, stage="transcode")
+            metrics.inc("music_bot_bytes_total", os.path.getsize(out_file), direction="transcode")
+            logger.info(
+                f"Transcode {video_id} ({quality}): cpu={cpu_time:.2f}s, wall={wall_time:.2f}s"
+            )
+            
+            # Файл не читаем в память - он уйдет в Telegram потоком с диска
+            audio_file = {
+                'path': out_file,
+                'filename': f"{os.path.basename(base)}.{codec}",
+                'title': source['title'],
+                'artist': source['artist'],
+                'duration': source['duration'],
+                'cpu_time': cpu_time,
             }
             
-            url = f"https://www.youtube.com/watch?v={video_id}"
+            # Переносим в дисковый кэш; если не влез - отдаем из temp_dir,
+            # который удалит release() после отправки
+            cached_path = audio_cache.put_file(video_id, quality, out_file, audio_file)
+            if cached_path:
+                audio_file['path'] = cached_path
+                shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                audio_file['temp_dir'] = temp_dir
+            return audio_file
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                if 'url' in info:
-                    return info['url']
-                    
-            return None
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+    
+    @staticmethod
+    def _resolve_sync(video_id: str):
+        """Только разбор страницы (форматы, подписи) без скачивания, в пуле resolve_lane"""
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        
+        with extractor_pool.lease('resolve') as ydl, metrics.timer("music_bot_stage_seconds", stage="extract"):
+            return ydl.extract_info(url, download=False, process=False)
+    
+    @staticmethod
+    async def playlist_page(list_id: str, offset: int, limit: int):
+        """Порция плейлиста (название, треки) без разбора самих видео"""
+        key = ('playlist', list_id, offset, limit)
+        cached = search_cache.get(key)
+        if cached is not None:
+            return cached
+        page = await search_flights.run(
+            key, lambda: search_lane.run(YouTubeDownloader._playlist_sync, list_id, offset, limit)
+        )
+        if page[1]:
+            search_cache.set(key, page)
+        return page
+    
+    @staticmethod
+    def _playlist_sync(list_id: str, offset: int, limit: int):
+        """Блокирующее чтение плейлиста, выполняется в пуле search_lane"""
+        url = f"https://www.youtube.com/playlist?list={list_id}"
+        lease = extractor_pool.lease('playlist', playlist_items=f"{offset + 1}-{offset + limit}")
+        
+        with lease as ydl, metrics.timer("music_bot_stage_seconds", stage="playlist"):
+            result = ydl.extract_info(url, download=False)
+        if not result:
+            return None, []
+        
+        tracks = []
+        for entry in list(result.get('entries') or [])[:limit]:
+            if entry and entry.get('id'):
+                seconds = int(entry.get('duration') or 0)
+                tracks.append({
+                    'id': entry['id'],
+                    'title': entry.get('title') or 'Без названия',
+                    'duration': f"{seconds // 60}:{seconds % 60:02d}" if seconds else '0:00',
+                    'channel': entry.get('channel') or entry.get('uploader') or 'Неизвестно',
+                })
+        return result.get('title') or 'Плейлист', tracks
+    
+    @staticmethod
+    async def get_direct_link(video_id: str):
+        """Получение прямой ссылки на аудио (альтернативный метод)"""
+        try:
+            return await search_flights.run(
+                ('direct', video_id),
+                lambda: search_lane.run(YouTubeDownloader._direct_link_sync, video_id)
+            )
         except Exception as e:
             logger.error(f"Direct link error: {e}")
             return None
+    
+    @staticmethod
+    def _direct_link_sync(video_id: str):
+        """Блокирующее получение ссылки, выполняется в пуле search_lane"""
+        url = f"https://www.youtube.com/watch?v={video_id}"
+        
+        with extractor_pool.lease('direct') as ydl:
+            info = ydl.extract_info(url, download=False)
+            if info and 'url' in info:
+                return info['url']
+                
+        return None
+
+# ================== ПРЕДЗАГРУЗКА ==================
+class Prefetcher:
+    """Фоновая подготовка выбранного трека до нажатия «Скачать»
+
+    В режиме resolve заранее разбирает страницу видео (самая долгая часть
+    до первого байта), в режиме download - сразу скачивает трек в кэш.
+    Новый выбор пользователя отменяет его прошлую предзагрузку; общее число
+    фоновых задач ограничено max_active, лишние просто не запускаются.
+    """
+
+    def __init__(self, mode: str, max_active: int, ttl: int):
+        self.mode = mode
+        self.max_active = max_active
+        self._info = TTLCache(max(20, max_active * 10), ttl)  # video_id -> сырой info
+        self._resolving = SingleFlight()
+        self._tasks = {}  # user_id -> asyncio.Task
+
+    @property
+    def active(self) -> int:
+        return sum(1 for task in self._tasks.values() if not task.done())
+
+    def start(self, user_id: int, video_id: str, quality: str):
+        if self.mode not in ("resolve", "download"):
+            return
+        self.cancel(user_id)
+        if self.active >= self.max_active:
+            metrics.inc("music_bot_prefetch_total", result="over_budget")
+            return
+
+        task = asyncio.create_task(self._run(video_id, quality))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda t: self._forget(user_id, t))
+
+    def cancel(self, user_id: int):
+        """Отменяет ожидание; общая задача продолжится, если к ней уже подключились"""
+        task = self._tasks.pop(user_id, None)
+        if task and not task.done():
+            task.cancel()
+            metrics.inc("music_bot_prefetch_total", result="cancelled")
+
+    def _forget(self, user_id: int, task: asyncio.Task):
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    async def _run(self, video_id: str, quality: str):
+        # Уже отправлялся - нажатие обслужит file_id, готовить нечего
+        if await audio_cache.get_file_id(video_id, quality):
+            return
+        try:
+            if self.mode == "download":
+                # Фон не занимает воркеры, если их ждут живые пользователи
+                if download_lane.busy:
+                    metrics.inc("music_bot_prefetch_total", result="lane_busy")
+                    return
+                audio_file = await YouTubeDownloader.download_audio(video_id, quality)
+                if audio_file:
+                    YouTubeDownloader.release(audio_file)
+            else:
+                # Ссылки, которые пользователи прислали сами, важнее догадок
+                if resolve_lane.busy:
+                    metrics.inc("music_bot_prefetch_total", result="lane_busy")
+                    return
+                await self.resolve(video_id)
+            metrics.inc("music_bot_prefetch_total", result="done")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Prefetch {video_id} failed: {e}")
+
+    async def resolve(self, video_id: str):
+        """Сырой info видео; остается в кэше, пока действуют подписи потоков"""
+        info = self._info.get(video_id)
+        metrics.inc("music_bot_cache_requests_total", cache="stream_url", result="hit" if info else "miss")
+        if info is not None:
+            return info
+        info = await self._resolving.run(
+            video_id, lambda: resolve_lane.run(YouTubeDownloader._resolve_sync, video_id)
+        )
+        self.remember(video_id, info)
+        return info
+
+    def remember(self, video_id: str, info: dict):
+        """Кладет сырой info в кэш до истечения подписей его потоков"""
+        if info:
+            ttl = min(self._info.ttl, info_ttl(info))
+            if ttl > 0:
+                self._info.set(video_id, info, ttl=ttl)
+
+    async def warm_info(self, video_id: str):
+        """Копия готового info или None; ждет идущий разбор
+
+        Копия - потому что yt-dlp дополняет info при обработке, а один и тот
+        же разбор служит всем скачиваниям трека, пока не истекли подписи.
+        """
+        if video_id in self._resolving:
+            try:
+                await self._resolving.run(video_id, None)
+            except Exception:
+                return None
+        info = self._info.get(video_id)
+        if info is None:
+            return None
+        metrics.inc("music_bot_prefetch_total", result="used")
+        return await asyncio.to_thread(copy.deepcopy, info)
+
+
+prefetcher = Prefetcher(PREFETCH_MODE, PREFETCH_MAX_ACTIVE, PREFETCH_TTL)
 
 # ================== КОМАНДЫ БОТА ==================
 @dp.message(Command("start"))
@@ -193,18 +2440,145 @@ async def quality_cmd(message: types.Message):
         [InlineKeyboardButton(text="🎵 Высокое (320kbps)", callback_data="quality_320")],
         [InlineKeyboardButton(text="🎶 Среднее (192kbps)", callback_data="quality_192")],
         [InlineKeyboardButton(text="📱 Низкое (128kbps)", callback_data="quality_128")],
+        [InlineKeyboardButton(text="⚡ Оригинал (без перекодирования)", callback_data="quality_original")],
     ])
     
     await message.answer(
         "⚙️ <b>Настройка качества аудио:</b>\n\n"
         "• <b>320kbps</b> - лучшее качество, больший размер\n"
         "• <b>192kbps</b> - оптимальное качество/размер (по умолчанию)\n"
-        "• <b>128kbps</b> - меньше размер, качество похуже\n\n"
+        "• <b>128kbps</b> - меньше размер, качество похуже\n"
+        "• <b>Оригинал</b> - родной поток YouTube (m4a), отдается быстрее всего\n\n"
         "Выберите качество:",
         reply_markup=keyboard
     )
 
+def _ratio(hits: int, misses: int) -> str:
+    total = hits + misses
+    return f"{hits / total:.0%}" if total else "—"
+
+@dp.message(Command("stats"))
+async def stats_cmd(message: types.Message):
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ Команда доступна только администратору")
+        return
+    
+    summary = await stats_store.summary()
+    total, day = summary['all'], summary['last_24h']
+    uptime = str(datetime.now() - BOT_STARTED).split('.')[0]
+    
+    qualities = ", ".join(
+        f"{QUALITY_NAMES.get(q, q).split(' ')[0]}: {total.get(f'quality:{q}', 0)}"
+        for q in QUALITY_NAMES
+    )
+    
+    await message.answer(
+        f"📊 <b>Статистика бота</b>\n\n"
+        f"⏱ Аптайм: {uptime}\n"
+        f"👥 Пользователи: сегодня {summary['users_today']}, всего {summary['users_total']}\n\n"
+        f"⬇️ <b>Скачивания</b>\n"
+        f"• за 24ч: {day.get('downloads', 0)} (ошибок {day.get('failed', 0)})\n"
+        f"• всего: {total.get('downloads', 0)} (ошибок {total.get('failed', 0)})\n"
+        f"• по качеству: {qualities}\n\n"
+        f"🔍 <b>Поиски</b>: за 24ч {day.get('searches', 0)}, всего {total.get('searches', 0)}\n\n"
+        f"⚡ <b>Кэш (всего)</b>\n"
+        f"• file_id: {_ratio(total.get('file_id_hit', 0), total.get('file_id_miss', 0))}\n"
+        f"• файлы на диске: {_ratio(total.get('disk_cache_hit', 0), total.get('disk_cache_miss', 0))}\n"
+        f"• поиск: {_ratio(total.get('search_cache_hit', 0), total.get('search_cache_miss', 0))}"
+    )
+
 # ================== ПОИСК ==================
+def compact_video(video: dict) -> dict:
+    """Только поля, нужные карточке трека (ссылки восстанавливаются по id)"""
+    return {
+        'id': video['id'],
+        'title': video['title'],
+        'duration': video['duration'],
+        'channel': video['channel'],
+    }
+
+YOUTUBE_LINK_RE = re.compile(
+    r"(?:youtube\.com/(?:watch\?(?:[^\s#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})"
+)
+
+PLAYLIST_LINK_RE = re.compile(r"youtube\.com/playlist\?(?:[^\s#]*&)?list=([\w-]+)")
+
+def youtube_playlist_id(text: str):
+    """id плейлиста или альбома из ссылки youtube.com/playlist?list=..."""
+    match = PLAYLIST_LINK_RE.search(text)
+    return match.group(1) if match else None
+
+def youtube_video_id(text: str):
+    """id видео из ссылки youtube.com / youtu.be / music.youtube.com / shorts"""
+    match = YOUTUBE_LINK_RE.search(text)
+    return match.group(1) if match else None
+
+def duration_seconds(duration: str) -> int:
+    """'1:02:03' / '3:45' -> секунды; 0, если длительность неизвестна"""
+    try:
+        seconds = 0
+        for part in str(duration).split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+    except ValueError:
+        return 0
+
+def page_bounds(page: int, first_page: int = SEARCH_PAGE_SIZE):
+    """Границы страницы в списке результатов
+
+    Первая страница бывает короче остальных (ответ из индекса), следующие
+    начинаются сразу после нее, чтобы ни один результат не пропал.
+    """
+    if page == 0:
+        return 0, first_page
+    start = first_page + (page - 1) * SEARCH_PAGE_SIZE
+    return start, start + SEARCH_PAGE_SIZE
+
+def last_page(count: int, first_page: int = SEARCH_PAGE_SIZE) -> int:
+    """Номер последней непустой страницы для count результатов"""
+    if count <= first_page:
+        return 0
+    return 1 + (count - first_page - 1) // SEARCH_PAGE_SIZE
+
+def search_results_view(query: str, videos: list, page: int, exhausted: bool,
+                        first_page: int = SEARCH_PAGE_SIZE):
+    """Текст и клавиатура страницы результатов поиска"""
+    start, end = page_bounds(page, first_page)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    
+    for i, video in enumerate(videos[start:end], start):
+        title = video['title'][:40] + "..." if len(video['title']) > 40 else video['title']
+        duration = video['duration'] if video['duration'] != '0:00' else "N/A"
+        
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(
+                text=f"{i+1}. {title} ({duration})",
+                callback_data=f"select_{video['id']}"
+            )
+        ])
+    
+    # Кнопки листания: назад по уже загруженным, вперед - с догрузкой
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️ Назад", callback_data="prev_results"))
+    has_more = len(videos) > end or (
+        not exhausted and len(videos) < SEARCH_MAX_RESULTS
+    )
+    if has_more:
+        nav.append(InlineKeyboardButton(text="📋 Еще результаты", callback_data="more_results"))
+    if nav:
+        keyboard.inline_keyboard.append(nav)
+    keyboard.inline_keyboard.append([
+        InlineKeyboardButton(text="🔍 Новый поиск", callback_data="new_search")
+    ])
+    
+    text = (
+        f"✅ <b>Результаты {start + 1}-{min(len(videos), end)}:</b>\n"
+        f"Запрос: <code>{query}</code>\n\n"
+        f"<i>Выберите трек для скачивания:</i>"
+    )
+    return text, keyboard
+
 @dp.message(Command("search"))
 async def search_cmd(message: types.Message, state: FSMContext):
     await message.answer("🔍 <b>Введите название песни или исполнителя:</b>")
@@ -218,12 +2592,37 @@ async def handle_search(message: types.Message, state: FSMContext = None):
         await message.answer("❌ Введите минимум 2 символа")
         return
     
+    # Ссылка на плейлист или альбом - предлагаем скачать целиком
+    list_id = youtube_playlist_id(query)
+    if list_id:
+        await handle_playlist_link(message, state, list_id)
+        return
+    
+    # Ссылка на видео - поиск не нужен, сразу карточка трека
+    video_id = youtube_video_id(query)
+    if video_id:
+        await handle_link(message, state, video_id)
+        return
+    
+    stats_store.record("searches", user_id=message.from_user.id)
+    
     # Отправляем сообщение о поиске
     msg = await message.answer(f"🔍 <b>Ищем:</b> <code>{query}</code>")
     
     try:
-        # Ищем видео
-        videos = await YouTubeDownloader.search_youtube(query, limit=10)
+        # Сначала уже отправленные треки: уверенное совпадение обходится без YouTube,
+        # а «Еще результаты» затем ищет на YouTube
+        videos = track_index.search(query, SEARCH_PAGE_SIZE, TRACK_INDEX_MIN_SCORE)
+        metrics.inc("music_bot_cache_requests_total", cache="index", result="hit" if videos else "miss")
+        from_index = bool(videos)
+        if from_index:
+            exhausted = False
+            yt_offset = 0
+        else:
+            # Ищем только первую страницу, остальные - по кнопке «Еще результаты»
+            videos = await YouTubeDownloader.search_youtube(query, limit=SEARCH_PAGE_SIZE)
+            exhausted = len(videos) < SEARCH_PAGE_SIZE
+            yt_offset = len(videos)
         
         if not videos:
             await msg.edit_text(f"❌ По запросу <code>{query}</code> ничего не найдено")
@@ -231,54 +2630,123 @@ async def handle_search(message: types.Message, state: FSMContext = None):
         
         # Сохраняем в FSM context
         if state:
-            await state.update_data(videos=videos, query=query)
-        
-        # Создаем клавиатуру
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+            await state.update_data(
+                videos=[compact_video(v) for v in videos], query=query, page=0,
+                exhausted=exhausted, yt_offset=yt_offset, first_page=len(videos)
+            )
         
-        for i, video in enumerate(videos[:8]):  # Показываем первые 8
-            title = video['title'][:40] + "..." if len(video['title']) > 40 else video['title']
-            duration = video['duration'] if video['duration'] != '0:00' else "N/A"
-            
-            keyboard.inline_keyboard.append([
-                InlineKeyboardButton(
-                    text=f"{i+1}. {title} ({duration})",
-                    callback_data=f"select_{video['id']}"
-                )
-            ])
-        
-        # Добавляем кнопки управления
-        keyboard.inline_keyboard.append([
-            InlineKeyboardButton(text="🔍 Новый поиск", callback_data="new_search"),
-            InlineKeyboardButton(text="📋 Еще результаты", callback_data="more_results")
-        ])
-        
-        await msg.edit_text(
-            f"✅ <b>Найдено {len(videos)} результатов:</b>\n"
-            f"Запрос: <code>{query}</code>\n\n"
-            f"<i>Выберите трек для скачивания:</i>",
-            reply_markup=keyboard
-        )
+        text, keyboard = search_results_view(query, videos, 0, exhausted, len(videos))
+        if from_index:
+            text = "⚡ <i>Из уже скачанных треков</i>\n" + text
+        await msg.edit_text(text, reply_markup=keyboard)
         
+    except QueueFullError:
+        await msg.edit_text("⏳ Сервер перегружен поиском. Попробуйте через минуту.")
     except Exception as e:
         logger.error(f"Search error: {e}")
         await msg.edit_text("❌ Ошибка при поиске. Попробуйте другой запрос.")
 
-# ================== ВЫБОР ТРЕКА ==================
-@dp.callback_query(F.data.startswith("select_"))
-async def handle_selection(callback: types.CallbackQuery, state: FSMContext):
-    video_id = callback.data.replace("select_", "")
+async def handle_link(message: types.Message, state: FSMContext, video_id: str):
+    """Карточка трека по ссылке: страница разбирается один раз и потом идет в скачивание"""
+    stats_store.record("links", user_id=message.from_user.id)
+    msg = await message.answer("🔗 <b>Открываю ссылку...</b>")
     
-    # Получаем данные из состояния
+    try:
+        info = await prefetcher.resolve(video_id)
+    except QueueFullError:
+        await msg.edit_text("⏳ Сервер перегружен. Попробуйте через минуту.")
+        return
+    except Exception as e:
+        logger.error(f"Link resolve error: {e}")
+        info = None
+    if not info:
+        await msg.edit_text("❌ Не удалось открыть видео по ссылке")
+        return
+    
+    seconds = int(info.get('duration') or 0)
+    video = {
+        'id': video_id,
+        'title': info.get('title') or 'Без названия',
+        'duration': f"{seconds // 60}:{seconds % 60:02d}" if seconds else '0:00',
+        'channel': info.get('channel') or info.get('uploader') or 'Неизвестно',
+    }
+    data = await state.get_data() if state else {}
+    quality = stored_quality(data)
+    if state:
+        await state.update_data(
+            videos=[video], query=video['title'], page=0, exhausted=True, yt_offset=0,
+            first_page=1
+        )
+    
+    text, keyboard, _ = track_card(video, quality)
+    await msg.edit_text(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.in_({"more_results", "prev_results"}))
+async def handle_more_results(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
+    query = data.get('query')
     videos = data.get('videos', [])
+    if not query or not videos:
+        await callback.answer("❌ Поиск устарел, начните новый")
+        return
     
-    # Находим выбранный трек
-    selected_video = next((v for v in videos if v['id'] == video_id), None)
+    page = data.get('page', 0) + (1 if callback.data == "more_results" else -1)
+    page = max(0, page)
+    exhausted = data.get('exhausted', False)
+    first_page = data.get('first_page', SEARCH_PAGE_SIZE)
+    start, end = page_bounds(page, first_page)
     
-    if not selected_video:
-        await callback.answer("❌ Трек не найден")
-        return
+    yt_offset = data.get('yt_offset', len(videos))
+    
+    # Догружаем только недостающую страницу, уже полученные не трогаем.
+    # Результаты из индекса могут повториться на YouTube - пропускаем их
+    if len(videos) < end and not exhausted:
+        await callback.answer("🔍 Ищем еще...")
+        known = {v['id'] for v in videos}
+        try:
+            while (len(videos) < end and not exhausted
+                   and yt_offset < SEARCH_MAX_RESULTS):
+                more = await YouTubeDownloader.search_youtube(
+                    query, limit=SEARCH_PAGE_SIZE, offset=yt_offset
+                )
+                yt_offset += len(more)
+                exhausted = len(more) < SEARCH_PAGE_SIZE
+                for video in more:
+                    if video['id'] not in known:
+                        known.add(video['id'])
+                        videos = videos + [compact_video(video)]
+        except QueueFullError:
+            await callback.message.answer("⏳ Сервер перегружен поиском. Попробуйте через минуту.")
+            return
+        except Exception as e:
+            # Кнопка «Еще результаты» остается - можно нажать еще раз
+            logger.error(f"Search error: {e}")
+            await callback.message.answer("❌ Ошибка при поиске. Попробуйте еще раз.")
+            return
+    else:
+        await callback.answer()
+    
+    if start >= len(videos):
+        # Больше ничего не нашлось - остаемся на последней странице
+        page = last_page(len(videos), first_page)
+    
+    await state.update_data(videos=videos, page=page, exhausted=exhausted, yt_offset=yt_offset)
+    text, keyboard = search_results_view(query, videos, page, exhausted, first_page)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+# ================== ВЫБОР ТРЕКА ==================
+def track_card(video: dict, quality: str):
+    """Текст, клавиатура карточки трека и качество, в котором он будет скачан
+
+    Качество None - трек не поместится в лимит Telegram ни в каком битрейте.
+    """
+    video_id = video['id']
+    
+    # Заранее видно, влезет ли трек в лимит Telegram на выбранном качестве
+    try:
+        planned = fit_quality(quality, duration_seconds(video.get('duration')))
+    except TrackTooLargeError:
+        planned = None
     
     # Клавиатура с опциями
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -293,104 +2761,625 @@ async def handle_selection(callback: types.CallbackQuery, state: FSMContext):
     ])
     
     # Информация о треке
-    duration = selected_video.get('duration', 'N/A')
-    channel = selected_video.get('channel', 'Неизвестно')
+    duration = video.get('duration', 'N/A')
+    channel = video.get('channel', 'Неизвестно')
     
-    await callback.message.edit_text(
+    if planned is None:
+        size_note = f"⛔ Слишком длинный: не поместится в {UPLOAD_LIMIT_MB} MB\n"
+    elif planned != quality:
+        size_note = f"⚠️ Будет скачан в {quality_label(planned)}, чтобы уложиться в {UPLOAD_LIMIT_MB} MB\n"
+    else:
+        size_note = ""
+    
+    text = (
         f"🎵 <b>Выбран трек:</b>\n\n"
-        f"📌 <b>{selected_video['title']}</b>\n"
+        f"📌 <b>{video['title']}</b>\n"
         f"⏱ Длительность: {duration}\n"
-        f"👤 Канал: {channel}\n\n"
-        f"<i>Выберите действие:</i>",
-        reply_markup=keyboard
+        f"👤 Канал: {channel}\n"
+        f"{size_note}\n"
+        f"<i>Выберите действие:</i>"
     )
+    return text, keyboard, planned
+
+@dp.callback_query(F.data.startswith("select_"))
+async def handle_selection(callback: types.CallbackQuery, state: FSMContext):
+    video_id = callback.data.replace("select_", "")
+    
+    # Получаем данные из состояния
+    data = await state.get_data()
+    videos = data.get('videos', [])
+    
+    # Находим выбранный трек
+    selected_video = next((v for v in videos if v['id'] == video_id), None)
+    
+    if not selected_video:
+        await callback.answer("❌ Трек не найден")
+        return
+    
+    quality = stored_quality(data)
+    text, keyboard, planned = track_card(selected_video, quality)
+    
+    # Пока пользователь смотрит карточку, готовим трек в фоне
+    if planned:
+        prefetcher.start(callback.from_user.id, video_id, planned)
+    
+    await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 # ================== СКАЧИВАНИЕ ==================
+def stored_quality(data: dict) -> str:
+    """Качество из FSM; устаревшее или подделанное значение - как по умолчанию"""
+    quality = data.get('quality')
+    return quality if quality in QUALITY_NAMES else '192'
+
+def quality_label(quality: str) -> str:
+    """Короткое название качества для подписи"""
+    return "оригинал" if quality == ORIGINAL_QUALITY else f"{quality}kbps"
+
+def audio_send_kwargs(meta: dict, quality: str) -> dict:
+    """Подпись и теги для bot.send_audio"""
+    duration = int(meta.get('duration') or 0)
+    duration_str = f"{duration//60}:{duration%60:02d}" if duration > 0 else "N/A"
+    title = meta.get('title') or 'audio'
+    artist = meta.get('artist') or 'Unknown'
+    
+    return {
+        'caption': (
+            f"🎵 <b>{title[:50]}</b>\n"
+            f"👤 {artist[:30]}\n"
+            f"⏱ {duration_str}\n"
+            f"🎧 Качество: {quality_label(quality)}\n\n"
+            f"<i>Скачано через Music Bot</i>"
+        ),
+        'title': title[:30],
+        'performer': artist[:30],
+        'duration': duration if duration > 0 else None,
+    }
+
+async def upload_audio(chat_id: int, video_id: str, quality: str, audio_file: dict) -> types.Message:
+    """Отправляет скачанный файл, запоминает file_id и освобождает временную папку"""
+    # Отправляем файл потоком с диска, не держа его целиком в памяти
+    try:
+        # Оценка по длительности могла ошибиться (VBR, "original")
+        if os.path.getsize(audio_file['path']) > UPLOAD_LIMIT_MB * 1024 * 1024:
+            raise TrackTooLargeError(f"{video_id} is larger than {UPLOAD_LIMIT_MB} MB")
+        with metrics.timer("music_bot_stage_seconds", stage="upload"):
+            sent = await bot.send_audio(
+                chat_id=chat_id,
+                audio=types.FSInputFile(
+                    audio_file['path'],
+                    filename=audio_file['filename'][:64]  # Ограничение длины имени
+                ),
+                **audio_send_kwargs(audio_file, quality)
+            )
+        metrics.inc("music_bot_bytes_total", os.path.getsize(audio_file['path']), direction="upload")
+    finally:
+        YouTubeDownloader.release(audio_file)
+    
+    # Запоминаем file_id для повторных отправок
+    if sent.audio:
+        await audio_cache.put_file_id(video_id, quality, sent.audio.file_id, audio_file)
+        track_index.add(video_id, quality, sent.audio.file_id, audio_file)
+    return sent
+
+async def download_with_progress(msg: types.Message, video_id: str, quality: str):
+    """download_audio, показывая прогресс не чаще раза в PROGRESS_INTERVAL"""
+    progress = YouTubeDownloader.progress_for(video_id, quality)
+    reporter = asyncio.create_task(report_progress(msg, progress, quality))
+    try:
+        return await YouTubeDownloader.download_audio(video_id, quality)
+    finally:
+        reporter.cancel()
+
 @dp.callback_query(F.data.startswith("download_"))
 async def handle_download(callback: types.CallbackQuery, state: FSMContext):
     video_id = callback.data.replace("download_", "")
     
     # Получаем качество из состояния
     data = await state.get_data()
-    quality = data.get('quality', '192')
+    quality = stored_quality(data)
+    
+    # Длительность нужна планировщику: короткие треки идут первыми
+    video = next((v for v in data.get('videos', []) if v['id'] == video_id), None)
+    duration = duration_seconds(video['duration']) if video else 0
+    
+    # Не начинаем то, что Telegram все равно не примет
+    try:
+        planned = fit_quality(quality, duration)
+    except TrackTooLargeError:
+        metrics.inc("music_bot_size_plan_total", result="refused")
+        await callback.answer(
+            f"⛔ Трек слишком длинный: файл не поместится в {UPLOAD_LIMIT_MB} MB", show_alert=True
+        )
+        return
+    metrics.inc("music_bot_size_plan_total", result="fit" if planned == quality else "downgraded")
+    size_note = ""
+    if planned != quality:
+        size_note = f"\n⚠️ Качество понижено до {quality_label(planned)}, чтобы уложиться в {UPLOAD_LIMIT_MB} MB"
+        quality = planned
     
     await callback.answer("⏳ Начинаем скачивание...")
     
     # Сообщение о скачивании
     msg = await callback.message.answer(
         "⬇️ <b>Скачиваю трек...</b>\n"
-        "⏳ Это может занять несколько секунд"
+        f"⏳ Это может занять несколько секунд{size_note}"
     )
     
+    user_id = callback.from_user.id
+    job_id = await job_store.add(user_id, msg.chat.id, msg.message_id, video_id, quality, duration)
+    await run_download_job(job_id, user_id, video_id, quality, duration, msg)
+
+class StatusMessage:
+    """Статусное сообщение, известное только по id (после перезапуска)"""
+
+    def __init__(self, chat_id: int, message_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+    async def edit_text(self, text: str, **kwargs):
+        return await bot.edit_message_text(
+            text=text, chat_id=self.chat_id, message_id=self.message_id, **kwargs
+        )
+
+async def run_download_job(job_id: int, user_id: int, video_id: str, quality: str,
+                           duration: int, msg):
+    """Выполняет задачу из журнала; при остановке процесса запись остается"""
+    await job_store.start(job_id)
+    finished = True
+    try:
+        await deliver_track(user_id, video_id, quality, duration, msg)
+    except asyncio.CancelledError:
+        # Процесс останавливается - задача продолжится после запуска
+        finished = False
+        raise
+    finally:
+        if finished:
+            await job_store.finish(job_id)
+
+async def deliver_track(user_id: int, video_id: str, quality: str, duration: int, msg):
+    """Отправка по file_id или скачивание и загрузка; результат - в статусном сообщении"""
+    done_note = ""
     try:
-        # Скачиваем аудио
-        audio_file = await YouTubeDownloader.download_audio(video_id, quality)
+        # Трек уже отправлялся - пересылаем по file_id без скачивания
+        cached = await audio_cache.get_file_id(video_id, quality)
+        metrics.inc(
+            "music_bot_cache_requests_total", cache="file_id", result="hit" if cached else "miss"
+        )
+        if cached:
+            try:
+                await bot.send_audio(
+                    chat_id=user_id,
+                    audio=cached['file_id'],
+                    **audio_send_kwargs(cached, quality)
+                )
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached file_id rejected for {video_id}: {e}")
+                await audio_cache.drop_file_id(video_id, quality)
+                track_index.drop_file_id(video_id, quality)
+                cached = None
         
-        if not audio_file or 'data' not in audio_file:
-            await msg.edit_text("❌ Не удалось скачать трек")
-            return
+        if not cached:
+            # Этот же трек уже скачивается для другого - просто присоединяемся,
+            # отдельный слот планировщика не нужен
+            if (video_id, quality) in download_flights:
+                audio_file = await download_with_progress(msg, video_id, quality)
+            else:
+                if download_scheduler.would_wait(user_id):
+                    download_scheduler.check_capacity(user_id)
+                    await set_status(
+                        msg,
+                        f"⏳ <b>Вы #{download_scheduler.waiting + 1} в очереди</b>\n"
+                        "Скачивание начнется автоматически"
+                    )
+                # Неизвестная длительность считается типичной песней
+                async with download_scheduler.slot(user_id, duration or 240):
+                    audio_file = await download_with_progress(msg, video_id, quality)
+            
+            if not audio_file or 'path' not in audio_file:
+                stats_store.record("failed", user_id=user_id)
+                await set_status(msg, "❌ Не удалось скачать трек")
+                return
+            
+            # Настоящая длительность могла потребовать битрейт ниже
+            if audio_file.get('quality', quality) != quality:
+                quality = audio_file['quality']
+                done_note = f"\n⚠️ Качество понижено до {quality_label(quality)}, чтобы уложиться в {UPLOAD_LIMIT_MB} MB"
+            await upload_audio(user_id, video_id, quality, audio_file)
         
         # Обновляем статистику
-        stats["total_downloads"] += 1
-        user_id = callback.from_user.id
-        if user_id not in stats["users"]:
-            stats["users"][user_id] = {"downloads": 0, "username": callback.from_user.username}
-        stats["users"][user_id]["downloads"] += 1
-        
-        # Отправляем файл
-        duration = audio_file.get('duration', 0)
-        duration_str = f"{duration//60}:{duration%60:02d}" if duration > 0 else "N/A"
-        
-        await bot.send_audio(
-            chat_id=callback.from_user.id,
-            audio=types.BufferedInputFile(
-                audio_file['data'],
-                filename=audio_file['filename'][:64]  # Ограничение длины имени
-            ),
-            caption=(
-                f"🎵 <b>{audio_file['title'][:50]}</b>\n"
-                f"👤 {audio_file['artist'][:30]}\n"
-                f"⏱ {duration_str}\n"
-                f"🎧 Качество: {quality}kbps\n\n"
-                f"<i>Скачано через Music Bot</i>"
-            ),
-            title=audio_file['title'][:30],
-            performer=audio_file['artist'][:30],
-            duration=int(duration) if duration > 0 else None
+        stats_store.record(
+            "downloads",
+            f"quality:{quality}",
+            "file_id_hit" if cached else "file_id_miss",
+            user_id=user_id
         )
         
         # Обновляем сообщение
-        await msg.edit_text(f"✅ <b>Готово!</b> Трек отправлен в чат")
+        await set_status(msg, f"✅ <b>Готово!</b> Трек отправлен в чат{done_note}")
         
-        # Очищаем временные файлы
-        if 'temp_dir' in audio_file:
-            shutil.rmtree(audio_file['temp_dir'], ignore_errors=True)
-        
-        logger.info(f"Download successful: user={user_id}, track={video_id}")
+        logger.info(f"Download successful: user={user_id}, track={video_id}, cached={bool(cached)}")
         
+    except TrackTooLargeError:
+        metrics.inc("music_bot_size_plan_total", result="refused")
+        await set_status(
+            msg,
+            f"⛔ <b>Файл не поместится в {UPLOAD_LIMIT_MB} MB</b>\n"
+            "Выберите качество пониже или другой трек"
+        )
+    except UserQuotaError:
+        await set_status(
+            msg,
+            "⏳ <b>У вас уже много треков в очереди</b>\n"
+            "Дождитесь, пока скачаются предыдущие"
+        )
+    except QueueFullError:
+        await set_status(
+            msg,
+            "⏳ <b>Очередь скачиваний переполнена</b>\n"
+            "Попробуйте еще раз через пару минут"
+        )
     except Exception as e:
         logger.error(f"Download failed: {e}")
-        stats["failed_downloads"] += 1
-        await msg.edit_text(
+        stats_store.record("failed", user_id=user_id)
+        await set_status(
+            msg,
             f"❌ <b>Ошибка скачивания:</b>\n"
             f"<code>{str(e)[:100]}</code>\n\n"
             f"Попробуйте другой трек или качество"
         )
+
+
+# ================== INLINE-РЕЖИМ ==================
+async def user_quality(user_id: int) -> str:
+    """Качество, выбранное пользователем в личном чате с ботом"""
+    context = dp.fsm.get_context(bot=bot, chat_id=user_id, user_id=user_id)
+    return stored_quality(await context.get_data())
+
+async def inline_candidates(query: str, deadline: float) -> list:
+    """Треки для inline-ответа: индекс, затем кэш поиска или YouTube в пределах срока"""
+    videos = track_index.search(query, INLINE_RESULTS, TRACK_INDEX_MIN_SCORE)
+    if len(videos) >= INLINE_RESULTS:
+        return videos
+    
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return videos
+    try:
+        # Поиск, не успевший к сроку, продолжится в фоне и попадет в кэш
+        # к следующему символу запроса
+        found = await asyncio.wait_for(
+            YouTubeDownloader.search_youtube(query, limit=INLINE_RESULTS), remaining
+        )
+    except (asyncio.TimeoutError, QueueFullError):
+        metrics.inc("music_bot_inline_total", result="deadline")
+        return videos
+    except Exception as e:
+        logger.error(f"Inline search error: {e}")
+        return videos
+    
+    known = {v['id'] for v in videos}
+    return videos + [v for v in found if v['id'] not in known][:INLINE_RESULTS - len(videos)]
+
+def inline_result(video: dict, quality: str):
+    """Готовое аудио по file_id или заглушка, которую заменит скачанный трек"""
+    track = track_index.get(video['id'])
+    file_ids = track['file_ids'] if track else {}
+    file_id = file_ids.get(quality) or next(iter(file_ids.values()), None)
+    if file_id:
+        return types.InlineQueryResultCachedAudio(id=f"a:{video['id']}", audio_file_id=file_id)
+    
+    # Длительность в id: по ней выбор планирует качество и очередь
+    return types.InlineQueryResultArticle(
+        id=f"dl:{video['id']}:{duration_seconds(video.get('duration'))}",
+        title=video['title'],
+        description=f"{video.get('channel', '')} · {video.get('duration', '')} · ⬇️ скачать",
+        input_message_content=types.InputTextMessageContent(
+            message_text=f"⏳ <b>Загружаю:</b> {video['title'][:60]}",
+        ),
+        # Без клавиатуры Telegram не пришлет inline_message_id для замены
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="🎬 YouTube", url=f"https://youtu.be/{video['id']}")
+        ]]),
+    )
+
+@dp.inline_query()
+async def handle_inline_query(inline_query: types.InlineQuery):
+    deadline = time.monotonic() + INLINE_DEADLINE
+    query = inline_query.query.strip()
+    if len(query) < 2:
+        await inline_query.answer([], cache_time=5)
+        return
+    
+    with metrics.timer("music_bot_stage_seconds", stage="inline"):
+        quality = await user_quality(inline_query.from_user.id)
+        videos = await inline_candidates(query, deadline)
+        metrics.inc("music_bot_inline_total", result="answered" if videos else "empty")
+        # Заглушки со временем превращаются в аудио - кэшируем ответ ненадолго
+        await inline_query.answer(
+            [inline_result(v, quality) for v in videos], cache_time=30, is_personal=True
+        )
+
+@dp.chosen_inline_result(F.result_id.startswith("dl:"))
+async def handle_inline_chosen(chosen: types.ChosenInlineResult):
+    if not chosen.inline_message_id:
+        return
+    video_id, _, seconds = chosen.result_id[len("dl:"):].partition(":")
+    duration = int(seconds) if seconds.isdigit() else 0
+    user_id = chosen.from_user.id
+    quality = await user_quality(user_id)
+    
+    async def replace_text(text: str):
+        try:
+            await bot.edit_message_text(text=text, inline_message_id=chosen.inline_message_id)
+        except TelegramAPIError as e:
+            logger.warning(f"Inline placeholder update failed: {e}")
+    
+    try:
+        # Как и в личном чате: длинный трек - пониже битрейт, а не отказ
+        quality = fit_quality(quality, duration)
+        cached = await audio_cache.get_file_id(video_id, quality)
+        if cached:
+            file_id, meta = cached['file_id'], cached
+        else:
+            if (video_id, quality) in download_flights:
+                audio_file = await YouTubeDownloader.download_audio(video_id, quality)
+            else:
+                async with download_scheduler.slot(user_id, duration or 240):
+                    audio_file = await YouTubeDownloader.download_audio(video_id, quality)
+            if not audio_file or 'path' not in audio_file:
+                await replace_text("❌ Не удалось скачать трек")
+                return
+            quality = audio_file.get('quality', quality)
+            
+            # В inline-сообщение нельзя загрузить файл - только подставить file_id
+            sent = await upload_audio(INLINE_CACHE_CHAT_ID or user_id, video_id, quality, audio_file)
+            if not sent.audio:
+                await replace_text("❌ Не удалось загрузить трек")
+                return
+            file_id, meta = sent.audio.file_id, audio_file
+            if not INLINE_CACHE_CHAT_ID:
+                # Вспомогательная копия в личке больше не нужна
+                try:
+                    await bot.delete_message(chat_id=user_id, message_id=sent.message_id)
+                except TelegramAPIError:
+                    pass
+        
+        await bot.edit_message_media(
+            inline_message_id=chosen.inline_message_id,
+            media=types.InputMediaAudio(media=file_id, **audio_send_kwargs(meta, quality)),
+        )
+        stats_store.record("downloads", f"quality:{quality}", "inline", user_id=user_id)
+        
+    except TrackTooLargeError:
+        await replace_text(f"⛔ Трек не поместится в {UPLOAD_LIMIT_MB} MB")
+    except QueueFullError:
+        await replace_text("⏳ Очередь скачиваний переполнена, попробуйте позже")
+    except Exception as e:
+        logger.error(f"Inline download failed: {e}")
+        stats_store.record("failed", user_id=user_id)
+        await replace_text("❌ Ошибка скачивания")
+
+# ================== ПЛЕЙЛИСТЫ ==================
+class PlaylistBatch:
+    """Скачивание плейлиста конвейером
+
+    Список разворачивается порциями по мере продвижения. Треки качаются
+    параллельно (до PLAYLIST_PARALLEL через общий планировщик, так что
+    другие пользователи не ждут весь альбом), а отправляются строго по
+    порядку. Уже отправлявшиеся треки уходят по file_id без скачивания.
+    Окно начатых, но еще не отправленных треков ограничено, чтобы готовые
+    файлы не копились на диске: сверх PLAYLIST_PARALLEL скачиваемых в
+    очереди ждут не больше USER_MAX_QUEUED, как и у обычных скачиваний.
+    Принятый в окно трек ждет слота, а не получает отказ при полной очереди.
+    """
+
+    def __init__(self, user_id: int, list_id: str, title: str, quality: str, msg: types.Message):
+        self.user_id = user_id
+        self.list_id = list_id
+        self.title = title
+        self.quality = quality
+        self.msg = msg
+        self.total = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.expanded = False
+        self._window = asyncio.Semaphore(max(1, PLAYLIST_PARALLEL) + USER_MAX_QUEUED)
+        self._last_report = 0.0
+
+    async def run(self):
+        queue = asyncio.Queue()
+        producer = asyncio.create_task(self._produce(queue))
+        try:
+            await self._deliver(queue)
+        finally:
+            producer.cancel()
+            self._drain(queue)
+        await self._report(final=True)
+
+    async def _produce(self, queue: asyncio.Queue):
+        """Разворачивает плейлист и запускает скачивание, не обгоняя отправку"""
+        offset = 0
+        try:
+            while offset < PLAYLIST_MAX_TRACKS:
+                limit = min(PLAYLIST_PAGE_SIZE, PLAYLIST_MAX_TRACKS - offset)
+                _, tracks = await YouTubeDownloader.playlist_page(self.list_id, offset, limit)
+                for track in tracks:
+                    await self._window.acquire()
+                    self.total += 1
+                    await queue.put((track, asyncio.create_task(self._fetch(track))))
+                offset += len(tracks)
+                if len(tracks) < limit:
+                    break
+        except Exception as e:
+            logger.error(f"Playlist {self.list_id} expand error: {e}")
+        finally:
+            self.expanded = True
+            await queue.put(None)
+
+    async def _fetch(self, track: dict):
+        """(качество, file_id из кэша, скачанный файл) или None, если трек не влезет"""
+        duration = duration_seconds(track['duration'])
+        try:
+            quality = fit_quality(self.quality, duration)
+        except TrackTooLargeError:
+            return None
+        
+        cached = await audio_cache.get_file_id(track['id'], quality)
+        if cached:
+            return quality, cached, None
+        
+        if (track['id'], quality) in download_flights:
+            audio_file = await YouTubeDownloader.download_audio(track['id'], quality)
+        else:
+            async with download_scheduler.slot(self.user_id, duration or 240, limit=PLAYLIST_PARALLEL):
+                audio_file = await YouTubeDownloader.download_audio(track['id'], quality)
+        if audio_file:
+            quality = audio_file.get('quality', quality)
+        return quality, None, audio_file
+
+    async def _deliver(self, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            track, task = item
+            try:
+                await self._send(track, await task)
+            except TrackTooLargeError:
+                self.skipped += 1
+            except Exception as e:
+                logger.error(f"Playlist track {track['id']} failed: {e}")
+                self.failed += 1
+            finally:
+                self._window.release()
+            await self._report()
+
+    async def _send(self, track: dict, result):
+        if result is None:
+            self.skipped += 1
+            return
+        quality, cached, audio_file = result
+        if cached:
+            await bot.send_audio(
+                chat_id=self.user_id, audio=cached['file_id'], **audio_send_kwargs(cached, quality)
+            )
+        elif audio_file and 'path' in audio_file:
+            await upload_audio(self.user_id, track['id'], quality, audio_file)
+        else:
+            self.failed += 1
+            return
+        self.sent += 1
+        stats_store.record(
+            "downloads", f"quality:{quality}", "file_id_hit" if cached else "file_id_miss",
+            user_id=self.user_id
+        )
+
+    def _drain(self, queue: asyncio.Queue):
+        """После прерывания: отменяет начатые задачи и освобождает готовые файлы"""
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item is None:
+                continue
+            _, task = item
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None and task.result():
+                audio_file = task.result()[2]
+                if audio_file:
+                    YouTubeDownloader.release(audio_file)
+
+    async def _report(self, final: bool = False):
+        now = time.monotonic()
+        if not final and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
         
-        # Очищаем временные файлы при ошибке
+        total = f"{self.total}" if self.expanded else f"{self.total}+"
+        text = f"📀 <b>{self.title}</b>\n\n✅ Отправлено: {self.sent} из {total}"
+        if self.skipped:
+            text += f"\n⛔ Пропущено (больше {UPLOAD_LIMIT_MB} MB): {self.skipped}"
+        if self.failed:
+            text += f"\n❌ Не удалось: {self.failed}"
+        text += "\n\n🏁 <b>Готово!</b>" if final else "\n\n⬇️ Скачиваю..."
         try:
-            temp_files = list(TEMP_DIR.glob("*"))
-            for temp in temp_files:
-                if temp.is_dir():
-                    shutil.rmtree(temp, ignore_errors=True)
-        except:
-            pass
+            await self.msg.edit_text(text)
+        except TelegramAPIError as e:
+            logger.warning(f"Playlist progress update failed: {e}")
+
+
+playlist_batches = {}  # user_id -> PlaylistBatch (один плейлист на пользователя)
+
+async def handle_playlist_link(message: types.Message, state: FSMContext, list_id: str):
+    """Карточка плейлиста: название и первые треки, кнопка «Скачать все»"""
+    stats_store.record("playlists", user_id=message.from_user.id)
+    msg = await message.answer("📀 <b>Открываю плейлист...</b>")
+    
+    try:
+        title, tracks = await YouTubeDownloader.playlist_page(list_id, 0, PLAYLIST_PAGE_SIZE)
+    except QueueFullError:
+        await msg.edit_text("⏳ Сервер перегружен. Попробуйте через минуту.")
+        return
+    except Exception as e:
+        logger.error(f"Playlist open error: {e}")
+        tracks = []
+    if not tracks:
+        await msg.edit_text("❌ Не удалось открыть плейлист")
+        return
+    
+    if state:
+        await state.update_data(playlist={'id': list_id, 'title': title})
+    
+    more = "+" if len(tracks) == PLAYLIST_PAGE_SIZE else ""
+    lines = "\n".join(f"{i}. {t['title'][:50]} ({t['duration']})" for i, t in enumerate(tracks, 1))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬇️ Скачать все", callback_data="playlist_download")],
+        [InlineKeyboardButton(text="🔍 Новый поиск", callback_data="new_search")],
+    ])
+    await msg.edit_text(
+        f"📀 <b>{title}</b>\n"
+        f"Треков: {len(tracks)}{more} (не больше {PLAYLIST_MAX_TRACKS})\n\n"
+        f"{lines}",
+        reply_markup=keyboard
+    )
+
+@dp.callback_query(F.data == "playlist_download")
+async def handle_playlist_download(callback: types.CallbackQuery, state: FSMContext):
+    user_id = callback.from_user.id
+    data = await state.get_data()
+    playlist = data.get('playlist')
+    if not playlist:
+        await callback.answer("❌ Плейлист не найден, отправьте ссылку еще раз")
+        return
+    if user_id in playlist_batches:
+        await callback.answer("⏳ Предыдущий плейлист еще скачивается")
+        return
+    
+    await callback.answer("⏳ Начинаем скачивание...")
+    msg = await callback.message.answer(f"📀 <b>{playlist['title']}</b>\n\n⬇️ Скачиваю...")
+    
+    batch = PlaylistBatch(user_id, playlist['id'], playlist['title'], stored_quality(data), msg)
+    playlist_batches[user_id] = batch
+    try:
+        await batch.run()
+    finally:
+        playlist_batches.pop(user_id, None)
+    logger.info(
+        f"Playlist done: user={user_id}, list={playlist['id']}, "
+        f"sent={batch.sent}, skipped={batch.skipped}, failed={batch.failed}"
+    )
 
 # ================== ДОПОЛНИТЕЛЬНЫЕ КНОПКИ ==================
 @dp.callback_query(F.data == "new_search")
 async def new_search_handler(callback: types.CallbackQuery, state: FSMContext):
+    prefetcher.cancel(callback.from_user.id)
+    
+    # Сбрасываем поиск, но сохраняем выбранное качество
+    data = await state.get_data()
     await state.clear()
+    if 'quality' in data:
+        await state.update_data(quality=data['quality'])
     await callback.message.edit_text(
         "🔍 <b>Новый поиск</b>\n\n"
         "Введите название песни или исполнителя:"
@@ -400,15 +3389,12 @@ async def new_search_handler(callback: types.CallbackQuery, state: FSMContext):
 @dp.callback_query(F.data.startswith("quality_"))
 async def quality_handler(callback: types.CallbackQuery, state: FSMContext):
     quality = callback.data.replace("quality_", "")
-    
-    quality_names = {
-        "320": "Высокое (320kbps)",
-        "192": "Среднее (192kbps)",
-        "128": "Низкое (128kbps)"
-    }
+    if quality not in QUALITY_NAMES:
+        await callback.answer("❌ Неизвестное качество")
+        return
     
     await state.update_data(quality=quality)
-    await callback.answer(f"✅ Установлено качество: {quality_names.get(quality, quality)}kbps")
+    await callback.answer(f"✅ Установлено качество: {QUALITY_NAMES.get(quality, quality)}")
 
 @dp.callback_query(F.data == "change_quality")
 async def change_quality_handler(callback: types.CallbackQuery):
@@ -416,6 +3402,7 @@ async def change_quality_handler(callback: types.CallbackQuery):
         [InlineKeyboardButton(text="🎵 320kbps", callback_data="quality_320")],
         [InlineKeyboardButton(text="🎶 192kbps", callback_data="quality_192")],
         [InlineKeyboardButton(text="📱 128kbps", callback_data="quality_128")],
+        [InlineKeyboardButton(text="⚡ Оригинал", callback_data="quality_original")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_track")],
     ])
     
@@ -437,43 +3424,155 @@ async def cleanup_temp_files():
     """Очистка временных файлов каждые 10 минут"""
     while True:
         try:
-            now = datetime.now()
-            temp_items = list(TEMP_DIR.glob("*"))
-            
-            for item in temp_items:
-                if item.is_dir():
-                    # Удаляем папки старше 1 часа
-                    mtime = datetime.fromtimestamp(item.stat().st_mtime)
-                    if (now - mtime).seconds > 3600:
-                        shutil.rmtree(item, ignore_errors=True)
-                elif item.is_file():
-                    # Удаляем файлы старше 1 часа
-                    mtime = datetime.fromtimestamp(item.stat().st_mtime)
-                    if (now - mtime).seconds > 3600:
-                        item.unlink(missing_ok=True)
-            
-            logger.info(f"Cleanup: удалено {len(temp_items)} временных файлов")
+            # Папки идущих и ждущих продолжения задач не трогаем
+            active = await job_store.active_keys()
+            busy = {f"{video_id}_{quality}" for video_id, quality in active}
+            removed = await asyncio.to_thread(
+                sweep_work_dirs, busy, TEMP_MAX_AGE, TEMP_MAX_MB * 1024 * 1024
+            )
+            logger.info(f"Cleanup: удалено {removed} временных папок и файлов")
+            purged = await storage.purge_expired()
+            logger.info(f"FSM: {purged} expired sessions purged")
+            logger.info(
+                f"Search cache: {len(search_cache)} entries, "
+                f"hits={search_cache.hits}, misses={search_cache.misses}, "
+                f"ratio={search_cache.hit_ratio:.2f}"
+            )
+            logger.info(
+                f"Transcoder: {transcoder.jobs} jobs, cpu={transcoder.cpu_seconds:.1f}s, "
+                f"queue={transcode_lane.pending}/{transcode_lane.workers}"
+            )
         except Exception as e:
             logger.error(f"Cleanup error: {e}")
         
         await asyncio.sleep(600)  # 10 минут
 
+async def resume_jobs():
+    """Продолжает скачивания, прерванные остановкой процесса"""
+    jobs = await job_store.unfinished()
+    if jobs:
+        logger.info(f"Resuming {len(jobs)} interrupted downloads")
+    for job in jobs:
+        asyncio.create_task(resume_job(job))
+
+async def resume_job(job: dict):
+    msg = StatusMessage(job['chat_id'], job['message_id'])
+    expired = time.time() - (job['created'] or 0) > JOB_RESUME_MAX_AGE
+    try:
+        if expired or job['attempts'] >= JOB_MAX_ATTEMPTS:
+            await job_store.finish(job['id'])
+            await msg.edit_text("❌ <b>Скачивание прервано</b>\nЗапросите трек еще раз")
+            return
+        await msg.edit_text("🔄 <b>Бот перезапустился</b>\nПродолжаю скачивание...")
+    except TelegramAPIError as e:
+        logger.warning(f"Resume status update failed for job {job['id']}: {e}")
+    
+    await run_download_job(
+        job['id'], job['user_id'], job['video_id'], job['quality'], job['duration'], msg
+    )
+
+# ================== HTTP-СЕРВЕР ==================
+async def health_handler(request: web.Request) -> web.Response:
+    return web.Response(text="Music Bot is alive!")
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def start_web_server() -> web.AppRunner:
+    """Поднимает aiohttp-сервер: health-check, /metrics и (в режиме webhook) прием обновлений"""
+    app = web.Application()
+    app.router.add_get("/", health_handler)
+    app.router.add_get("/health", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    
+    if BOT_MODE == "webhook":
+        SimpleRequestHandler(
+            dispatcher=dp,
+            bot=bot,
+            secret_token=WEBHOOK_SECRET or None
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEB_HOST, WEB_PORT).start()
+    logger.info(f"🌐 HTTP server: http://{WEB_HOST}:{WEB_PORT} ({BOT_MODE})")
+    return runner
+
 # ================== ЗАПУСК ==================
 async def main():
     logger.info("=" * 50)
     logger.info("🎵 MUSIC DOWNLOAD BOT")
     logger.info(f"📁 Temp dir: {TEMP_DIR.absolute()}")
+    logger.info(f"📡 Mode: {BOT_MODE}")
     logger.info("✅ Starting bot...")
     logger.info("=" * 50)
     
-    # Запускаем очистку временных файлов
+    # Поднимаем сохраненный кэш поиска
+    if SEARCH_CACHE_FILE:
+        try:
+            search_cache.load(SEARCH_CACHE_FILE)
+            logger.info(f"Search cache loaded: {len(search_cache)} entries")
+        except Exception as e:
+            logger.error(f"Search cache load error: {e}")
+    
+    # Индекс отправленных треков строится из таблицы file_id
+    try:
+        started = time.monotonic()
+        track_index.load(audio_cache)
+        logger.info(f"Track index: {len(track_index)} tracks in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        logger.error(f"Track index load error: {e}")
+    
+    # Запускаем очистку временных файлов и сброс статистики
     asyncio.create_task(cleanup_temp_files())
+    asyncio.create_task(stats_store.run_flusher(STATS_FLUSH_INTERVAL))
     
-    # Удаляем старые вебхуки
-    await bot.delete_webhook(drop_pending_updates=True)
+    runner = await start_web_server()
     
     # Запускаем бота
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            # Очередь не сбрасываем: при выкатке реплик обновления не теряются
+            await bot.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            # SIGTERM при выкатке: выходим через finally, сохраняя статистику и кэши
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                try:
+                    loop.add_signal_handler(sig, stop.set)
+                except NotImplementedError:
+                    pass  # Windows: остается KeyboardInterrupt
+            mark_ready()
+            asyncio.create_task(warm_extractors())
+            asyncio.create_task(resume_jobs())
+            await stop.wait()
+        else:
+            # Удаляем старые вебхуки
+            await bot.delete_webhook(drop_pending_updates=True)
+            mark_ready()
+            asyncio.create_task(warm_extractors())
+            asyncio.create_task(resume_jobs())
+            await dp.start_polling(bot)
+    finally:
+        await runner.cleanup()
+        if SEARCH_CACHE_FILE:
+            try:
+                search_cache.save(SEARCH_CACHE_FILE)
+            except Exception as e:
+                logger.error(f"Search cache save error: {e}")
+        search_lane.shutdown()
+        resolve_lane.shutdown()
+        download_lane.shutdown()
+        transcode_lane.shutdown()
+        await storage.close()
+        await stats_store.close()
+        job_store.close()
+        audio_cache.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
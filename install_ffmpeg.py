@@ -1,6 +1,6 @@
 import os
 import zipfile
-import requests
+import urllib.request
 import subprocess
 import sys
 
@@ -21,12 +21,10 @@ def download_ffmpeg():
     
     try:
         # Скачиваем
-        response = requests.get(url, stream=True)
-        total_size = int(response.headers.get('content-length', 0))
-        
-        with open(zip_path, 'wb') as f:
+        with urllib.request.urlopen(url) as response, open(zip_path, 'wb') as f:
+            total_size = int(response.headers.get('content-length', 0))
             downloaded = 0
-            for chunk in response.iter_content(chunk_size=8192):
+            for chunk in iter(lambda: response.read(8192), b''):
                 if chunk:
                     f.write(chunk)
                     downloaded += len(chunk)
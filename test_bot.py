@@ -0,0 +1,852 @@
+"""Модульные тесты чистой логики бота (без сети и Telegram)
+
+Запуск:
+    python -m pytest -q test_bot.py
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import EditMessageText, SendMessage
+
+# Бот читает настройки и создает базы при импорте - уводим все во временную папку
+WORK_DIR = tempfile.mkdtemp(prefix="music_bot_test_")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(WORK_DIR)
+os.environ.update({
+    'TELEGRAM_TOKEN': '123456:TEST-TOKEN',
+    'DB_PATH': os.path.join(WORK_DIR, 'bot.db'),
+    'CACHE_DIR': os.path.join(WORK_DIR, 'audio_cache'),
+    'UPLOAD_LIMIT_MB': '50',
+    'SEARCH_PAGE_SIZE': '5',
+})
+
+import bot  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeClock:
+    """Подмена модуля time внутри bot: время двигается только вручную"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+# ================== ПЛАНИРОВЩИК ==================
+def _scheduler(slots=1, user_limit=1, user_queue_limit=5, queue_limit=50, priority=()):
+    return bot.FairScheduler(slots, user_limit, user_queue_limit, queue_limit, priority)
+
+
+def test_scheduler_prefers_short_tracks_and_other_users():
+    scheduler = _scheduler(slots=1)
+    order = []
+
+    async def job(user_id, duration, name):
+        async with scheduler.slot(user_id, duration):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        blocker = asyncio.create_task(job(0, 10, "blocker"))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(job(1, 3600, "mix-1")),
+            asyncio.create_task(job(1, 3600, "mix-2")),
+            asyncio.create_task(job(1, 180, "song-1")),
+            asyncio.create_task(job(2, 200, "song-2")),
+        ]
+        await asyncio.gather(blocker, *tasks)
+
+    run(scenario())
+    assert order[0] == "blocker"
+    # Короткий трек первого пользователя обгоняет его миксы,
+    # а песня второго не ждет часовых миксов первого
+    assert order.index("song-1") < order.index("mix-1")
+    assert order.index("song-2") < order.index("mix-2")
+
+
+def test_scheduler_limits_active_jobs_per_user():
+    scheduler = _scheduler(slots=4, user_limit=1)
+
+    async def scenario():
+        await scheduler.acquire(1, 100)
+        assert scheduler.would_wait(1)
+        assert not scheduler.would_wait(2)
+        waiter = asyncio.create_task(scheduler.acquire(1, 100))
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 1
+        scheduler.release(1)
+        await waiter
+        assert scheduler.active == 1 and scheduler.waiting == 0
+        scheduler.release(1)
+
+    run(scenario())
+
+
+def test_scheduler_batch_limit_does_not_lift_single_limit():
+    scheduler = _scheduler(slots=10, user_limit=1)
+
+    async def scenario():
+        for _ in range(3):
+            await scheduler.acquire(1, 100, limit=3)
+        # Пакет занял свои три слота, но обычное скачивание идет по своей квоте
+        assert scheduler.would_wait(1, limit=3)
+        assert not scheduler.would_wait(1)
+        await scheduler.acquire(1, 100)
+        assert scheduler.would_wait(1)
+        assert scheduler.active == 4
+
+    run(scenario())
+
+
+def test_scheduler_quota_and_queue_limits():
+    scheduler = _scheduler(slots=1, user_queue_limit=1, queue_limit=2, priority=(99,))
+
+    async def scenario():
+        await scheduler.acquire(1, 100)
+        first = asyncio.create_task(scheduler.acquire(2, 100))
+        await asyncio.sleep(0)
+        with pytest.raises(bot.UserQuotaError):
+            scheduler.check_capacity(2)
+        second = asyncio.create_task(scheduler.acquire(3, 100))
+        await asyncio.sleep(0)
+        with pytest.raises(bot.QueueFullError):
+            scheduler.check_capacity(4)
+        # Приоритетных лимиты очереди не касаются
+        scheduler.check_capacity(99)
+        first.cancel()
+        second.cancel()
+        await asyncio.gather(first, second, return_exceptions=True)
+        assert scheduler.waiting == 0
+
+    run(scenario())
+
+
+def test_scheduler_cancelled_waiter_gives_slot_to_next():
+    scheduler = _scheduler(slots=1)
+
+    async def scenario():
+        await scheduler.acquire(1, 100)
+        cancelled = asyncio.create_task(scheduler.acquire(2, 50))
+        waiting = asyncio.create_task(scheduler.acquire(3, 100))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        scheduler.release(1)
+        await asyncio.wait_for(waiting, 1)
+        assert scheduler.active == 1 and scheduler.waiting == 0
+
+    run(scenario())
+
+
+def test_scheduler_batch_entries_wait_instead_of_failing():
+    scheduler = _scheduler(slots=1, queue_limit=1)
+
+    async def scenario():
+        await scheduler.acquire(1, 100)
+        single = asyncio.create_task(scheduler.acquire(3, 100))
+        await asyncio.sleep(0)
+        with pytest.raises(bot.QueueFullError):
+            scheduler.check_capacity(2)
+        # Трек пакета уже принят окном - ждет слота, а не падает
+        batch = asyncio.create_task(scheduler.acquire(2, 50, limit=3))
+        await asyncio.sleep(0)
+        assert scheduler.waiting == 2
+        scheduler.release(1)
+        await asyncio.wait_for(batch, 1)
+        scheduler.release(2, limit=3)
+        await asyncio.wait_for(single, 1)
+        assert scheduler.active == 1 and scheduler.waiting == 0
+
+    run(scenario())
+
+
+# ================== РАЗМЕР ФАЙЛА ==================
+def test_fit_quality_keeps_choice_when_it_fits():
+    assert bot.fit_quality("320", 600) == "320"
+    assert bot.fit_quality("128", 1800) == "128"
+
+
+def test_fit_quality_unknown_duration_is_unchanged():
+    assert bot.fit_quality("320", 0) == "320"
+
+
+def test_fit_quality_steps_down_to_best_fitting_bitrate():
+    # 30 минут в 320k - больше 50 MB, в 192k - меньше
+    assert bot.fit_quality("320", 1800) == "192"
+    # "original" оценивается как 192k и тоже понижается
+    assert bot.fit_quality(bot.ORIGINAL_QUALITY, 1800) == bot.ORIGINAL_QUALITY
+    assert bot.fit_quality(bot.ORIGINAL_QUALITY, 2500) == "128"
+
+
+def test_fit_quality_never_raises_bitrate():
+    assert bot.fit_quality("96", 3000) == "96"
+
+
+def test_fit_quality_refuses_what_never_fits():
+    with pytest.raises(bot.TrackTooLargeError):
+        bot.fit_quality("320", 8 * 3600)
+
+
+
+
+def test_stored_quality_falls_back_for_unknown_values():
+    assert bot.stored_quality({'quality': '320'}) == '320'
+    assert bot.stored_quality({'quality': bot.ORIGINAL_QUALITY}) == bot.ORIGINAL_QUALITY
+    assert bot.stored_quality({'quality': '999'}) == '192'
+    assert bot.stored_quality({'quality': 'abc'}) == '192'
+    assert bot.stored_quality({}) == '192'
+
+
+class FakeState:
+    def __init__(self):
+        self.data = {}
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+
+class FakeCallback:
+    def __init__(self, data: str):
+        self.data = data
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+def test_quality_handler_rejects_unknown_values():
+    state = FakeState()
+    forged = FakeCallback("quality_abc")
+    run(bot.quality_handler(forged, state))
+    assert state.data == {}
+    assert "Неизвестное" in forged.answers[0]
+
+    valid = FakeCallback("quality_128")
+    run(bot.quality_handler(valid, state))
+    assert state.data == {'quality': '128'}
+
+
+# ================== ЛИМИТЫ BOT API ==================
+def test_token_bucket_does_not_burst_after_pause(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    bucket = bot.TokenBucket(rate=1, capacity=5)
+
+    bucket.pause(10)
+    clock.now += 10
+    bucket._refill()
+    assert bucket.tokens == 0
+
+    clock.now += 2
+    bucket._refill()
+    assert bucket.tokens == pytest.approx(2)
+
+
+def test_token_bucket_refills_up_to_capacity(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    bucket = bot.TokenBucket(rate=2, capacity=3)
+    bucket.tokens = 0
+    clock.now += 100
+    assert bucket.idle
+    assert bucket.tokens == 3
+
+
+def _limiter(chat_rate=20.0, chat_burst=1):
+    return bot.TelegramRateLimiter(
+        global_rate=1000, chat_rate=chat_rate, chat_burst=chat_burst, group_rate=1, max_retries=2
+    )
+
+
+def test_limiter_coalesces_superseded_edits():
+    limiter = _limiter()
+    sent = []
+
+    async def make_request(_bot, method):
+        sent.append(method.text)
+        return True
+
+    async def scenario():
+        def edit(text):
+            return EditMessageText(chat_id=1, message_id=7, text=text)
+        # Первая правка забирает токен, вторая и третья ждут - уйти должна только третья
+        await limiter(make_request, None, edit("1%"))
+        await asyncio.gather(
+            limiter(make_request, None, edit("50%")),
+            limiter(make_request, None, edit("90%")),
+        )
+        # Повтор уже отправленного текста не отправляется вовсе
+        await limiter(make_request, None, edit("90%"))
+
+    run(scenario())
+    assert sent == ["1%", "90%"]
+
+
+def test_limiter_passes_requests_without_chat():
+    limiter = _limiter(chat_rate=0.001)
+    calls = []
+
+    async def make_request(_bot, method):
+        calls.append(method)
+        return "ok"
+
+    assert run(limiter(make_request, None, object())) == "ok"
+    assert len(calls) == 1
+
+
+def test_limiter_retry_after_pauses_only_the_chat():
+    limiter = _limiter(chat_rate=100, chat_burst=5)
+    method = SendMessage(chat_id=1, text="hi")
+    attempts = []
+
+    async def make_request(_bot, request):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise TelegramRetryAfter(method=request, message="Too Many Requests", retry_after=1)
+        return "ok"
+
+    assert run(limiter(make_request, None, method)) == "ok"
+    assert len(attempts) == 2
+    assert attempts[1] - attempts[0] >= 0.9
+    assert limiter._chat_buckets[1].paused_until >= attempts[0] + 0.9
+    # Один чат во flood control не тормозит остальные
+    assert limiter.global_bucket.paused_until < attempts[0]
+
+
+def test_limiter_pauses_all_chats_when_several_hit_flood_control():
+    limiter = _limiter(chat_rate=100, chat_burst=5)
+    failed = set()
+
+    async def make_request(_bot, request):
+        if request.chat_id not in failed:
+            failed.add(request.chat_id)
+            raise TelegramRetryAfter(method=request, message="Too Many Requests", retry_after=0.2)
+        return "ok"
+
+    async def scenario():
+        started = time.monotonic()
+        await asyncio.gather(*(
+            limiter(make_request, None, SendMessage(chat_id=chat_id, text="hi"))
+            for chat_id in range(1, limiter.GLOBAL_FLOOD_CHATS + 1)
+        ))
+        return started
+
+    started = run(scenario())
+    assert limiter.global_bucket.paused_until >= started + 0.2
+
+
+# ================== ПОДПИСИ ССЫЛОК ==================
+def test_stream_url_ttl_reads_expire_from_query():
+    expire = int(time.time()) + 3600
+    ttl = bot.stream_url_ttl(f"https://r1.googlevideo.com/videoplayback?expire={expire}&id=x")
+    assert 3600 - 60 - 5 < ttl <= 3600 - 60
+
+
+def test_stream_url_ttl_reads_expire_from_path():
+    expire = int(time.time()) + 600
+    ttl = bot.stream_url_ttl(f"https://manifest.googlevideo.com/api/manifest/hls/expire/{expire}/id/x")
+    assert 600 - 60 - 5 < ttl <= 600 - 60
+
+
+def test_stream_url_ttl_without_expire_uses_default():
+    assert bot.stream_url_ttl("https://example.com/audio.m4a") == bot.STREAM_URL_TTL
+
+
+def test_info_ttl_takes_earliest_signature():
+    now = int(time.time())
+    info = {'formats': [
+        {'url': f"https://x/videoplayback?expire={now + 7200}"},
+        {'url': f"https://x/videoplayback?expire={now + 900}"},
+        {'format_id': 'no-url'},
+    ]}
+    assert bot.info_ttl(info) <= 900 - 60
+    assert bot.info_ttl({}) == bot.STREAM_URL_TTL
+
+
+# ================== ХРАНИЛИЩЕ FSM ==================
+def _storage_key(user_id=42):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_storage_expires_search_results_but_keeps_prefs(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    storage = bot.SQLiteStorage(str(tmp_path / "fsm.db"), ttl=60, hot_size=10)
+    key = _storage_key()
+
+    async def scenario():
+        await storage.set_state(key, "Search:results")
+        await storage.set_data(key, {'quality': '320', 'videos': [{'id': 'x'}]})
+        assert await storage.get_data(key) == {'quality': '320', 'videos': [{'id': 'x'}]}
+
+        clock.now += 61
+        assert await storage.get_state(key) is None
+        assert await storage.get_data(key) == {'quality': '320'}
+
+        # Из базы после очистки - тоже только настройки
+        assert await storage.purge_expired() == 1
+        fresh = bot.SQLiteStorage(str(tmp_path / "fsm.db"), ttl=60, hot_size=10)
+        try:
+            assert await fresh.get_data(key) == {'quality': '320'}
+        finally:
+            await fresh.close()
+        await storage.close()
+
+    run(scenario())
+
+
+def test_storage_survives_restart_and_hot_cache_eviction(tmp_path):
+    path = str(tmp_path / "fsm.db")
+
+    async def scenario():
+        storage = bot.SQLiteStorage(path, ttl=3600, hot_size=1)
+        await storage.set_data(_storage_key(1), {'quality': '128', 'query': 'a'})
+        await storage.set_data(_storage_key(2), {'quality': '320'})
+        # Первый ключ вытеснен из горячего LRU и читается с диска
+        assert await storage.get_data(_storage_key(1)) == {'quality': '128', 'query': 'a'}
+        await storage.close()
+
+        restarted = bot.SQLiteStorage(path, ttl=3600, hot_size=10)
+        assert await restarted.get_data(_storage_key(2)) == {'quality': '320'}
+        await restarted.set_data(_storage_key(2), {})
+        assert await restarted.get_data(_storage_key(2)) == {}
+        await restarted.close()
+
+    run(scenario())
+
+
+# ================== ИНДЕКС ТРЕКОВ ==================
+def _index():
+    index = bot.TrackIndex()
+    index.add("ts1", "192", "file-ts", {
+        'title': "Taylor Swift - Love Story (Taylor's Version)", 'artist': "TaylorSwiftVEVO", 'duration': 236,
+    })
+    index.add("id1", "192", "file-id", {
+        'title': "Imagine Dragons - Believer (Official Music Video)", 'artist': "ImagineDragonsVEVO",
+        'duration': 204,
+    })
+    return index
+
+
+def test_track_index_matches_full_queries_in_any_word_order():
+    index = _index()
+    assert [t['id'] for t in index.search("taylor swift love story", 5, 0.75)] == ["ts1"]
+    assert [t['id'] for t in index.search("believer imagine dragons", 5, 0.75)] == ["id1"]
+    assert index.get("id1")['duration'] == "3:24"
+
+
+def test_track_index_ignores_generic_one_word_queries():
+    index = _index()
+    for query in ("love", "swift", "believer", "official video"):
+        assert index.search(query, 5, 0.75) == []
+
+
+def test_track_index_disabled_and_dropped_file_ids():
+    index = _index()
+    assert index.search("taylor swift love story", 5, 1.5) == []
+    index.drop_file_id("ts1", "192")
+    # Трек остается находимым, только без file_id
+    assert index.search("taylor swift love story", 5, 0.75)[0]['file_ids'] == {}
+
+
+
+
+class FakeMessage:
+    def __init__(self, text=""):
+        self.text = text
+        self.from_user = type("User", (), {'id': 42})()
+        self.edits = []
+
+    async def answer(self, text=None, **kwargs):
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeSearchState(FakeState):
+    async def get_data(self):
+        return dict(self.data)
+
+
+def test_more_results_after_index_answer_skips_nothing(monkeypatch):
+    found = [
+        {'id': f"yt{i}", 'title': f"Love Story {i}", 'duration': "3:00", 'channel': "YT"}
+        for i in range(20)
+    ]
+
+    async def search_youtube(query, limit=bot.SEARCH_PAGE_SIZE, offset=0):
+        return found[offset:offset + limit]
+
+    monkeypatch.setattr(bot, "track_index", _index())
+    monkeypatch.setattr(bot.YouTubeDownloader, "search_youtube", staticmethod(search_youtube))
+    state = FakeSearchState()
+    message = FakeMessage("taylor swift love story")
+    callback = FakeCallback("more_results")
+    callback.message = message
+
+    run(bot.handle_search(message, state))
+    assert [v['id'] for v in state.data['videos']] == ["ts1"]
+
+    # Вторая страница начинается сразу после ответа индекса
+    run(bot.handle_more_results(callback, state))
+    assert "Результаты 2-6" in message.edits[-1]
+    run(bot.handle_more_results(callback, state))
+    assert "Результаты 7-11" in message.edits[-1]
+    assert [v['id'] for v in state.data['videos'][:11]] == ["ts1"] + [f"yt{i}" for i in range(10)]
+
+    callback.data = "prev_results"
+    run(bot.handle_more_results(callback, state))
+    run(bot.handle_more_results(callback, state))
+    assert "Результаты 1-1" in message.edits[-1]
+
+
+# ================== КЭШ ПОИСКА ==================
+def test_search_pages_are_shared_between_page_sizes(monkeypatch):
+    calls = []
+
+    def fake_search(query, limit, offset=0):
+        calls.append((limit, offset))
+        return [{'id': f"v{i}", 'title': f"Track {i}"} for i in range(offset, offset + limit)]
+
+    monkeypatch.setattr(bot.YouTubeDownloader, "_search_sync", staticmethod(fake_search))
+
+    async def scenario():
+        inline = await bot.YouTubeDownloader.search_youtube("Shared Query", limit=10)
+        first = await bot.YouTubeDownloader.search_youtube("shared  query", limit=5)
+        second = await bot.YouTubeDownloader.search_youtube("shared query", limit=5, offset=5)
+        middle = await bot.YouTubeDownloader.search_youtube("shared query", limit=4, offset=3)
+        return inline, first, second, middle
+
+    inline, first, second, middle = run(scenario())
+    assert calls == [(10, 0)]
+    assert first + second == inline
+    assert middle == inline[3:7]
+
+
+def test_search_missing_deadline_still_fills_cache(monkeypatch):
+    def slow_search(query, limit, offset=0):
+        time.sleep(0.2)
+        return [{'id': f"d{i}", 'title': f"Deadline {i}"} for i in range(offset, offset + limit)]
+
+    monkeypatch.setattr(bot.YouTubeDownloader, "_search_sync", staticmethod(slow_search))
+
+    async def scenario():
+        videos = await bot.inline_candidates("deadline query", time.monotonic() + 0.05)
+        assert videos == []
+        await asyncio.sleep(0.4)
+        return bot.search_cache.get(("deadline query", bot.SEARCH_PAGE_SIZE, 0))
+
+    cached = run(scenario())
+    assert cached and cached[0]['id'] == "d0"
+
+
+def test_search_errors_propagate(monkeypatch):
+    def broken_search(query, limit, offset=0):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(bot.YouTubeDownloader, "_search_sync", staticmethod(broken_search))
+    with pytest.raises(RuntimeError):
+        run(bot.YouTubeDownloader.search_youtube("broken query", limit=5))
+
+
+def test_more_results_error_keeps_search_open(monkeypatch):
+    async def broken_search(query, limit=bot.SEARCH_PAGE_SIZE, offset=0):
+        raise RuntimeError("network down")
+
+    monkeypatch.setattr(bot.YouTubeDownloader, "search_youtube", staticmethod(broken_search))
+    state = FakeSearchState()
+    state.data.update(
+        videos=[{'id': "a", 'title': "A", 'duration': "3:00", 'channel': "C"}],
+        query="broken query", page=0, exhausted=False, yt_offset=1, first_page=1,
+    )
+    callback = FakeCallback("more_results")
+    callback.message = FakeMessage()
+
+    run(bot.handle_more_results(callback, state))
+    # Ошибка не считается концом выдачи - кнопку можно нажать еще раз
+    assert state.data['page'] == 0 and state.data['exhausted'] is False
+    assert callback.message.edits == []
+
+
+# ================== ПРЕДЗАГРУЗКА И ВРЕМЕННЫЕ ПАПКИ ==================
+def test_link_resolve_does_not_use_search_queue(monkeypatch):
+    monkeypatch.setattr(
+        bot.YouTubeDownloader, "_resolve_sync",
+        staticmethod(lambda video_id: {'id': video_id, 'title': "Linked"})
+    )
+    # Поиск перегружен, а ссылку все равно можно открыть
+    monkeypatch.setattr(bot.search_lane, "pending", bot.search_lane.workers + bot.search_lane.queue_limit)
+    with pytest.raises(bot.QueueFullError):
+        bot.search_lane.check_capacity()
+    info = run(bot.prefetcher.resolve("link_video"))
+    assert info['title'] == "Linked"
+
+
+def _fake_pipeline(monkeypatch, delay=0.1):
+    async def no_file(video_id, quality):
+        return None
+
+    async def no_info(video_id):
+        return None
+
+    def download(video_id, quality, progress=None, info=None, work_dir=None):
+        time.sleep(delay)
+        return os.path.join(work_dir, "source.webm")
+
+    def transcode(video_id, quality, source, progress=None):
+        path = os.path.join(os.path.dirname(source), "track.mp3")
+        with open(path, "wb") as f:
+            f.write(b"mp3")
+        return {'path': path, 'temp_dir': os.path.dirname(source), 'title': "T"}
+
+    monkeypatch.setattr(bot.audio_cache, "get_file", no_file)
+    monkeypatch.setattr(bot.prefetcher, "warm_info", no_info)
+    monkeypatch.setattr(bot.YouTubeDownloader, "_download_sync", staticmethod(download))
+    monkeypatch.setattr(bot.YouTubeDownloader, "_transcode_sync", staticmethod(transcode))
+
+
+def test_work_dir_released_when_all_waiters_cancelled(monkeypatch):
+    _fake_pipeline(monkeypatch)
+
+    async def scenario():
+        waiter = asyncio.create_task(bot.YouTubeDownloader.download_audio("cancelled", "128"))
+        await asyncio.sleep(0.02)
+        work_dir = str(bot.TEMP_DIR / "cancelled_128")
+        assert bot.temp_dir_refs.get(work_dir) == 0
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        # Задача доделывается сама и держит папку чуть дольше своего конца
+        await asyncio.sleep(0.3)
+        assert work_dir in bot.temp_dir_refs and os.path.isdir(work_dir)
+        await asyncio.sleep(1.0)
+        return work_dir
+
+    work_dir = run(scenario())
+    assert work_dir not in bot.temp_dir_refs
+    assert not os.path.exists(work_dir)
+
+
+def test_work_dir_kept_until_every_waiter_releases(monkeypatch):
+    _fake_pipeline(monkeypatch)
+
+    async def scenario():
+        first, second = await asyncio.gather(
+            bot.YouTubeDownloader.download_audio("shared", "128"),
+            bot.YouTubeDownloader.download_audio("shared", "128"),
+        )
+        assert first is second
+        bot.YouTubeDownloader.release(first)
+        await asyncio.sleep(1.2)
+        # Ссылка задачи отпущена, а второй получатель файл еще не отправил
+        assert os.path.exists(first['path'])
+        bot.YouTubeDownloader.release(second)
+        return first
+
+    audio_file = run(scenario())
+    assert not os.path.exists(audio_file['temp_dir'])
+    assert audio_file['temp_dir'] not in bot.temp_dir_refs
+
+
+# ================== ЖУРНАЛ ЗАДАЧ И РАБОЧИЕ ПАПКИ ==================
+def _work_dir(root, name, size, age):
+    path = root / name
+    path.mkdir()
+    (path / "audio.part").write_bytes(b"x" * size)
+    stamp = time.time() - age
+    os.utime(path / "audio.part", (stamp, stamp))
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+def test_sweep_work_dirs_keeps_busy_and_removes_old(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "TEMP_DIR", tmp_path)
+    old = _work_dir(tmp_path, "old_192", 10, 7200)
+    busy = _work_dir(tmp_path, "busy_192", 10, 7200)
+    sending = _work_dir(tmp_path, "sending_192", 10, 7200)
+    fresh = _work_dir(tmp_path, "fresh_192", 10, 60)
+    monkeypatch.setitem(bot.temp_dir_refs, str(sending), 1)
+
+    assert bot.sweep_work_dirs({"busy_192"}, 3600, 10 ** 6) == 1
+    assert not old.exists()
+    assert busy.exists() and sending.exists() and fresh.exists()
+
+
+def test_sweep_work_dirs_enforces_disk_budget_oldest_first(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "TEMP_DIR", tmp_path)
+    older = _work_dir(tmp_path, "older_192", 100, 600)
+    newer = _work_dir(tmp_path, "newer_192", 100, 60)
+    busy = _work_dir(tmp_path, "busy_192", 100, 900)
+
+    assert bot.sweep_work_dirs({"busy_192"}, 3600, 250) == 1
+    assert not older.exists()
+    assert newer.exists() and busy.exists()
+
+
+class FakeStatus:
+    edits = []
+
+    def __init__(self, chat_id, message_id):
+        self.key = (chat_id, message_id)
+
+    async def edit_text(self, text, **kwargs):
+        FakeStatus.edits.append((self.key, text))
+
+
+def test_resume_job_continues_or_gives_up(monkeypatch, tmp_path):
+    store = bot.JobStore(str(tmp_path / "jobs.db"))
+    resumed = []
+
+    async def fake_run(job_id, user_id, video_id, quality, duration, msg):
+        resumed.append(video_id)
+        await store.finish(job_id)
+
+    monkeypatch.setattr(bot, "job_store", store)
+    monkeypatch.setattr(bot, "StatusMessage", FakeStatus)
+    monkeypatch.setattr(bot, "run_download_job", fake_run)
+    FakeStatus.edits = []
+
+    async def scenario():
+        await store.add(1, 1, 10, "fresh", "192", 200)
+        crashing = await store.add(2, 2, 20, "crashing", "192", 200)
+        for _ in range(bot.JOB_MAX_ATTEMPTS):
+            await store.start(crashing)
+        assert await store.active_keys() == {("fresh", "192"), ("crashing", "192")}
+        for job in await store.unfinished():
+            await bot.resume_job(job)
+        return await store.unfinished()
+
+    try:
+        left = run(scenario())
+    finally:
+        store.close()
+    assert resumed == ["fresh"]
+    assert left == []
+    assert ((2, 20), "❌ <b>Скачивание прервано</b>\nЗапросите трек еще раз") in FakeStatus.edits
+
+
+# ================== СКЛЕЙКА ЗАПРОСОВ ==================
+def test_single_flight_coalesces_concurrent_calls():
+    flights = bot.SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def scenario():
+        results = await asyncio.gather(*(flights.run("key", work) for _ in range(5)))
+        assert "key" not in flights
+        return results
+
+    assert run(scenario()) == ["result"] * 5
+    assert len(calls) == 1
+
+
+def test_single_flight_cancelled_waiter_keeps_shared_task():
+    flights = bot.SingleFlight()
+
+    async def work():
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def scenario():
+        first = asyncio.create_task(flights.run("key", work))
+        second = asyncio.create_task(flights.run("key", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        assert first.cancelled()
+        return await second
+
+    assert run(scenario()) == "done"
+
+
+def test_single_flight_shares_exceptions_and_forgets_key():
+    flights = bot.SingleFlight()
+    calls = []
+
+    async def broken():
+        calls.append(1)
+        await asyncio.sleep(0)
+        raise RuntimeError("boom")
+
+    async def scenario():
+        results = await asyncio.gather(
+            flights.run("key", broken), flights.run("key", broken), return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert len(flights) == 0
+        # После ошибки следующий запрос запускает задачу заново
+        with pytest.raises(RuntimeError):
+            await flights.run("key", broken)
+
+    run(scenario())
+    assert len(calls) == 2
+
+
+# ================== КЭШ ТРЕКОВ ==================
+def test_audio_cache_evicts_least_recently_used(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    cache = bot.AudioCache(str(tmp_path / "cache.db"), tmp_path / "files", max_bytes=250)
+
+    def put(video_id):
+        src = tmp_path / f"{video_id}.mp3"
+        src.write_bytes(b"x" * 100)
+        return cache.put_file(video_id, "192", str(src), {'title': video_id})
+
+    try:
+        put("a")
+        clock.now += 100
+        put("b")
+        clock.now += 100
+        assert cache._get_file_sync("a", "192")
+        clock.now += 200
+        # Бюджет превышен - уходит b: к a обращались позже
+        put("c")
+        assert cache._get_file_sync("b", "192") is None
+        assert cache._get_file_sync("a", "192")
+        assert not (tmp_path / "files" / "b_192.mp3").exists()
+    finally:
+        cache.close()
+
+
+def test_audio_cache_keeps_files_that_may_still_be_uploading(monkeypatch, tmp_path):
+    clock = FakeClock()
+    monkeypatch.setattr(bot, "time", clock)
+    cache = bot.AudioCache(str(tmp_path / "cache.db"), tmp_path / "files", max_bytes=150)
+
+    def put(video_id):
+        src = tmp_path / f"{video_id}.mp3"
+        src.write_bytes(b"x" * 100)
+        return cache.put_file(video_id, "192", str(src), {'title': video_id})
+
+    try:
+        put("a")
+        clock.now += 60
+        put("b")
+        # a выдан меньше двух минут назад - бюджет временно превышен
+        assert (tmp_path / "files" / "a_192.mp3").exists()
+        clock.now += 120
+        put("c")
+        assert not (tmp_path / "files" / "a_192.mp3").exists()
+        assert (tmp_path / "files" / "b_192.mp3").exists()
+    finally:
+        cache.close()